@@ -0,0 +1,1076 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmarks for windows_service_monitor_svc.py
+
+Each benchmark works against a temporary SQLite db file + log file so it
+can be run anywhere without touching a live install:
+
+    python windows_service_monitor_bench.py             (runs everything)
+    python windows_service_monitor_bench.py log_writer  (runs one benchmark)
+
+"""
+
+import io
+import os
+import sys
+import time
+import datetime
+import shutil
+import random
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
+
+import windows_service_monitor_svc as wsm
+
+
+""" Creates a scratch directory holding a freshly initialized db + log file """
+def make_scratch_db():
+    tmpdir = tempfile.mkdtemp(prefix='wsm_bench_')
+    sqlite_dbfile = os.path.join(tmpdir, 'w32services.db')
+    logfile = os.path.join(tmpdir, 'w32services.log')
+    wsm.init_w32services_db(sqlite_dbfile)
+    return tmpdir, sqlite_dbfile, logfile
+
+""" Prints one result line in a consistent format """
+def report(name, value, unit):
+    print('  %-40s %14.1f %s' % (name, value, unit))
+
+""" Fails the benchmark run when a measured value is out of bounds """
+def require(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+""" rows/sec for the per-line connect/commit path vs sqlite_log_writer """
+def bench_log_writer(rows=2000):
+    print('log_writer (' + str(rows) + ' rows)')
+
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    try:
+        wsm.log_writer = None
+        start = time.perf_counter()
+        for i in range(rows):
+            wsm.write_to_log('bench log entry ' + str(i), 'svc' + str(i % 50), logfile, sqlite_dbfile)
+        elapsed = time.perf_counter() - start
+        report('per-line connect/commit', rows / elapsed, 'rows/sec')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    try:
+        wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+        start = time.perf_counter()
+        for i in range(rows):
+            wsm.write_to_log('bench log entry ' + str(i), 'svc' + str(i % 50), logfile, sqlite_dbfile)
+        wsm.log_writer.close()
+        elapsed = time.perf_counter() - start
+        report('sqlite_log_writer (batched)', rows / elapsed, 'rows/sec')
+    finally:
+        wsm.log_writer = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" statetable where every synthetic service is expected to be in the
+    opposite state, so each poll logs one "not in expectedstate" line per
+    service """
+def mismatched_statetable(backend):
+    statetable = {}
+    for short_name, desc, status in backend.enum_services():
+        wrong_state = 'SERVICE_RUNNING' if (status[1] == 1) else 'SERVICE_STOPPED'
+        statetable[short_name] = {'service_short_name': short_name,
+                                  'service_description': desc,
+                                  'laststate': wrong_state,
+                                  'expectedstate': wrong_state,
+                                  'forceexpectedstate': None,
+                                  'ignore_this_service': None,
+                                  'inactivated': None}
+    return statetable
+
+""" Poll-cycle time of check_services() writing synchronously vs through the
+    background writer thread, plus the writer's queue/latency counters """
+def bench_background_writer(services=500, polls=20):
+    print('background_writer (' + str(services) + ' mismatched services, ' + str(polls) + ' polls)')
+    backend = wsm.synthetic_scm_backend(services, seed=1)
+    for name in ('sqlite_log_writer', 'background_log_writer'):
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            wsm.log_writer = getattr(wsm, name)(sqlite_dbfile, logfile)
+            statetable = mismatched_statetable(backend)
+            worst = 0.0
+            start = time.perf_counter()
+            for i in range(polls):
+                poll_start = time.perf_counter()
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend)
+                wsm.log_writer.flush()
+                worst = max(worst, time.perf_counter() - poll_start)
+            poll_time = (time.perf_counter() - start) / polls
+            wsm.log_writer.close()
+            if (name == 'background_log_writer'):
+                stats = wsm.log_writer.stats()
+            report(name + ' mean poll', poll_time * 1000, 'ms')
+            report(name + ' worst poll', worst * 1000, 'ms')
+        finally:
+            wsm.log_writer = None
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    report('queue events written', stats['written'], 'events')
+    report('queue events dropped', stats['dropped'], 'events')
+    report('max queue depth', stats['max_queue_depth'], 'events')
+    report('mean write latency', stats['write_seconds'] / max(stats['written'], 1) * 1e6, 'us')
+
+""" Rows written to the db so far (win32service + win32service_log) """
+def db_row_count(sqlite_dbfile):
+    conn = sqlite3.connect(sqlite_dbfile)
+    count = conn.execute("SELECT (SELECT count(*) FROM win32service) + (SELECT count(*) FROM win32service_log)").fetchone()[0]
+    conn.close()
+    return count
+
+""" Poll-cycle latency, db write volume and memory for check_services()
+    against the synthetic backend at several fleet-image sizes.  The first
+    poll discovers every service (cold start), the rest apply churn """
+def bench_poll_cycle(sizes=(100, 1000, 10000, 100000), churn_rate=0.01, polls=10):
+    print('poll_cycle (churn ' + str(churn_rate) + ', ' + str(polls) + ' polls)')
+    for size in sizes:
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+            backend = wsm.synthetic_scm_backend(size, churn_rate=churn_rate, seed=size)
+            detector = wsm.service_change_detector()
+            statetable = {}
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+            wsm.log_writer.flush()
+            first_poll = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            cold_rows = db_row_count(sqlite_dbfile)
+
+            # monitor every service so state changes are logged
+            for svc in statetable.values():
+                svc['ignore_this_service'] = None
+            start = time.perf_counter()
+            for i in range(polls):
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                wsm.log_writer.flush()
+            poll_time = (time.perf_counter() - start) / polls
+            wsm.log_writer.close()
+
+            label = str(size) + ' services'
+            report(label + ' first poll', first_poll * 1000, 'ms')
+            report(label + ' steady poll', poll_time * 1000, 'ms')
+            report(label + ' rows written, first poll', cold_rows, 'rows')
+            report(label + ' rows written / steady poll', (db_row_count(sqlite_dbfile) - cold_rows) / polls, 'rows')
+            report(label + ' memory held after first poll', current / 1024.0, 'KiB')
+            report(label + ' peak memory, first poll', peak / 1024.0, 'KiB')
+        finally:
+            wsm.log_writer = None
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Steady-state poll time of a full walk of every enumerated service (no
+    detector, the pre-diff behaviour) vs the service_change_detector diff.
+    Services keep the default ignore_this_service = 'yes', so the time is
+    the enumeration walk itself plus the laststate updates for churned
+    services rather than "not in expectedstate" logging """
+def bench_change_detection(sizes=(1000, 10000, 100000), churn_rate=0.001, polls=20):
+    print('change_detection (churn ' + str(churn_rate) + ', ' + str(polls) + ' polls)')
+    for size in sizes:
+        for label, use_detector in (('full walk', False), ('diff engine', True)):
+            tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+            try:
+                wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+                backend = wsm.synthetic_scm_backend(size, churn_rate=churn_rate, seed=size)
+                detector = wsm.service_change_detector() if use_detector else None
+                statetable = {}
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                wsm.log_writer.flush()
+                start = time.perf_counter()
+                for i in range(polls):
+                    wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                    wsm.log_writer.flush()
+                poll_time = (time.perf_counter() - start) / polls
+                wsm.log_writer.close()
+                report(str(size) + ' services ' + label, poll_time * 1000, 'ms/poll')
+            finally:
+                wsm.log_writer = None
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" service_change_detector that records when each changed service was
+    first seen by a diff, for measuring detection latency """
+class timing_detector(wsm.service_change_detector):
+    def __init__(self):
+        wsm.service_change_detector.__init__(self)
+        self.seen = {}
+
+    def diff(self, statuses, defer=None):
+        added, changed, removed = wsm.service_change_detector.diff(self, statuses, defer)
+        now = time.perf_counter()
+        for entry in changed:
+            self.seen[entry[0]] = now
+        return added, changed, removed
+
+""" Detection latency and idle CPU of run_monitor() in polling mode vs
+    notification mode, driven by a synthetic backend and a scripted
+    notification source that reports each change as it is made """
+def bench_notifications(services=1000, changes=5, idle_seconds=10):
+    print('notifications (' + str(services) + ' services, ' + str(changes) + ' changes, ' + str(idle_seconds) + 's idle)')
+    rand = random.Random(1)
+    for mode in ('poll', 'notify'):
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            wsm.log_writer = wsm.background_log_writer(sqlite_dbfile, logfile)
+            backend = wsm.synthetic_scm_backend(services, seed=services)
+            detector = timing_detector()
+            notifications = wsm.scripted_notification_source() if (mode == 'notify') else None
+            # every service monitored, ignored ones are only checked every
+            # ignored_services_interval in poll mode
+            statetable = {}
+            wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+            for svc in statetable.values():
+                svc['ignore_this_service'] = None
+            stop = threading.Event()
+            monitor = threading.Thread(target=wsm.run_monitor,
+                                       args=(statetable, logfile, sqlite_dbfile, backend, detector, stop.wait, notifications))
+            monitor.start()
+
+            latencies = []
+            for i in range(changes):
+                time.sleep(rand.uniform(0.5, 1.5))
+                short_name = rand.choice(list(backend.services))
+                svc = backend.services[short_name]
+                detector.seen.pop(short_name, None)
+                changed_at = time.perf_counter()
+                svc[2] = 1 if (svc[2] == 4) else 4
+                if (notifications is not None):
+                    notifications.push('state', short_name)
+                while (short_name not in detector.seen):
+                    require(monitor.is_alive(), mode + ' monitor thread died')
+                    time.sleep(0.001)
+                latencies.append(detector.seen[short_name] - changed_at)
+
+            cpu_start = time.process_time()
+            time.sleep(idle_seconds)
+            idle_cpu = time.process_time() - cpu_start
+
+            stop.set()
+            if (notifications is not None):
+                notifications.interrupt()
+            monitor.join()
+            wsm.log_writer.close()
+            report(mode + ' mean detection latency', sum(latencies) / len(latencies) * 1000, 'ms')
+            report(mode + ' worst detection latency', max(latencies) * 1000, 'ms')
+            report(mode + ' idle cpu', idle_cpu / idle_seconds * 60 * 1000, 'ms/min')
+        finally:
+            wsm.log_writer = None
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Cost of refresh_service_metadata() passes over every known service
+    after the first poll, with a fraction of the service keys rewritten
+    between passes (new last-write time, half of them with a new account) """
+def bench_metadata_cache(services=5000, rounds=5, rewrite_rate=0.01):
+    print('metadata_cache (' + str(services) + ' services, ' + str(rounds) + ' refresh passes)')
+    rand = random.Random(1)
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    system_root = os.environ.get('SystemRoot')
+    os.environ['SystemRoot'] = 'C:\\Windows'
+    try:
+        wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+        backend = wsm.synthetic_scm_backend(services, seed=services)
+        cache = wsm.service_metadata_cache(backend, refresh_interval=0)
+        detector = wsm.service_change_detector()
+        statetable = {}
+        wsm.check_services(statetable, logfile, sqlite_dbfile, cache, detector)
+        names = list(backend.services)
+        # half the rows as older versions stored them, with %SystemRoot% unexpanded
+        for short_name in names[::2]:
+            statetable[short_name]['ImagePath'] = '%SystemRoot%\\System32\\' + short_name + '.exe'
+        reads = backend.registry_reads
+        rewritten = 0
+        reconfigured = 0
+        found = 0
+        start = time.perf_counter()
+        for i in range(rounds):
+            for j, short_name in enumerate(rand.sample(names, int(rewrite_rate * services))):
+                backend.key_writes[short_name] += 1
+                rewritten += 1
+                if (j % 2):
+                    backend.accounts[short_name] = 'NT AUTHORITY\\LocalService' + str(i)
+                    reconfigured += 1
+            found += len(wsm.refresh_service_metadata(statetable, logfile, sqlite_dbfile, cache, detector))
+        elapsed = time.perf_counter() - start
+        stats = cache.stats()
+        report('mean refresh pass', elapsed / rounds * 1000, 'ms')
+        report('registry value reads per pass', (backend.registry_reads - reads) / float(rounds), 'reads (' + str(rewritten // rounds) + ' keys rewritten)')
+        report('hit rate', stats['hit_rate'] * 100, '%')
+        report('reconfigured services found', found, 'of ' + str(reconfigured))
+        require(found == reconfigured, str(found) + ' services reported reconfigured, ' + str(reconfigured) + ' were')
+        wsm.log_writer.close()
+    finally:
+        wsm.log_writer = None
+        if (system_root is None):
+            del os.environ['SystemRoot']
+        else:
+            os.environ['SystemRoot'] = system_root
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Fills win32service with count synthetic rows """
+def populate_services(sqlite_dbfile, count):
+    backend = wsm.synthetic_scm_backend(count, seed=count)
+    rows = []
+    for short_name, desc, status in backend.enum_services():
+        new_svc = {'service_short_name': short_name,
+                   'service_description': desc,
+                   'laststate': wsm.serviceStates[status[1]],
+                   'expectedstate': wsm.serviceStates[status[1]],
+                   'servicetype': wsm.serviceTypes[status[0]],
+                   'ignore_this_service': 'yes'}
+        new_svc.update(backend.query_service_config(short_name))
+        rows.append(wsm.new_service_row(new_svc))
+    conn = sqlite3.connect(sqlite_dbfile)
+    with conn:
+        conn.executemany(wsm.insert_service_sql, rows)
+    conn.close()
+
+""" The original loader: fetchall() into a dict of dicts, for comparison """
+def read_dict_of_dicts(sqlite_dbfile):
+    keys = ('service_short_name', 'service_description', 'laststate', 'expectedstate',
+            'forceexpectedstate', 'servicetype', 'ImagePath', 'ObjectName',
+            'ignore_this_service', 'established', 'established_by', 'inactivated')
+    conn = sqlite3.connect(sqlite_dbfile)
+    statetable = {}
+    for row in conn.execute(wsm.statetable_sql).fetchall():
+        statetable[row[0]] = dict(zip(keys, row))
+    conn.close()
+    return statetable
+
+""" Load time and memory held by the statetable: the original dict of
+    dicts, the streamed service_record loader, and how soon polling can
+    start with the warming_state_table """
+def bench_cold_start(sizes=(1000, 10000, 100000)):
+    print('cold_start')
+    for size in sizes:
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            populate_services(sqlite_dbfile, size)
+            label = str(size) + ' rows '
+            for name, load in (('dict of dicts', lambda: read_dict_of_dicts(sqlite_dbfile)),
+                               ('service_record', lambda: wsm.read_state_table_from_db_file({}, logfile, sqlite_dbfile))):
+                tracemalloc.start()
+                start = time.perf_counter()
+                statetable = load()
+                elapsed = time.perf_counter() - start
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                report(label + name + ' load', elapsed * 1000, 'ms')
+                report(label + name + ' memory', current / 1024.0, 'KiB')
+                del statetable
+
+            start = time.perf_counter()
+            statetable = wsm.warming_state_table(logfile, sqlite_dbfile)
+            ready = time.perf_counter() - start
+            # a first poll lookup of a service that may not be loaded yet
+            found = ('SynthSvc%06d' % (size - 1)) in statetable
+            first_lookup = time.perf_counter() - start
+            statetable.wait_until_warm()
+            warm = time.perf_counter() - start
+            report(label + 'warming table, polling can start', ready * 1000, 'ms')
+            report(label + 'warming table, first lookup done', first_lookup * 1000, 'ms')
+            report(label + 'warming table, fully loaded', warm * 1000, 'ms')
+            require(found and (len(statetable) == size), 'warming table lost services before it was loaded')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Stands in for the time module inside windows_service_monitor_svc so a
+    long stretch of polls can be simulated without waiting for it """
+class simulated_clock:
+    def __init__(self):
+        self.now = time.monotonic()
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+""" Db log rows written over a simulated hour of 5 second polls, with a
+    fraction of the monitored services stuck out of their expectedstate:
+    logging every poll vs logging transitions plus periodic roll-ups """
+def bench_log_spam(services=500, stuck_fraction=0.1, hours=1):
+    polls = int(hours * 3600 / wsm.check_services_interval)
+    print('log_spam (' + str(services) + ' services, ' + str(int(stuck_fraction * 100)) + '% out of state, ' + str(polls) + ' polls)')
+    saved_mode = wsm.log_state_transitions_only
+    try:
+        for mode in (0, 1):
+            wsm.log_state_transitions_only = mode
+            tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+            clock = simulated_clock()
+            wsm.time = clock
+            try:
+                wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+                backend = wsm.synthetic_scm_backend(services, seed=services)
+                detector = wsm.service_change_detector()
+                statetable = {}
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                for i, svc in enumerate(statetable.values()):
+                    svc['ignore_this_service'] = None
+                    if (i < (services * stuck_fraction)):
+                        svc['expectedstate'] = 'SERVICE_PAUSED'
+                    detector.invalidate(svc['service_short_name'])
+                wsm.log_writer.flush()
+                baseline = db_row_count(sqlite_dbfile)
+                start = time.perf_counter()
+                for i in range(polls):
+                    clock.now += wsm.check_services_interval
+                    wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                    wsm.log_writer.flush()
+                elapsed = time.perf_counter() - start
+                wsm.log_writer.close()
+                label = 'every poll' if (mode == 0) else 'transitions only'
+                report(label + ' log rows', db_row_count(sqlite_dbfile) - baseline, 'rows')
+                report(label + ' mean poll', elapsed / polls * 1000, 'ms')
+            finally:
+                wsm.time = time
+                wsm.log_writer = None
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    finally:
+        wsm.log_state_transitions_only = saved_mode
+
+""" Poll time and start/stop attempts with forceexpectedstate services that
+    are slow, failing or stuck in START_PENDING: inline enforcement vs the
+    enforcement_scheduler thread pool (with backoff after failures) """
+def bench_enforcement(services=200, slow=8, failing=3, stuck=2, delay=0.25, polls=20, interval=0.1):
+    print('enforcement (' + str(slow) + ' slow, ' + str(failing) + ' failing, ' + str(stuck) + ' stuck of ' + str(services) + ' services, ' + str(polls) + ' polls)')
+    saved_mode = wsm.log_state_transitions_only
+    wsm.log_state_transitions_only = 0
+    try:
+        for mode in ('inline', 'scheduler'):
+            tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+            try:
+                wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+                backend = wsm.synthetic_scm_backend(services, seed=3)
+                detector = wsm.service_change_detector()
+                statetable = {}
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                names = sorted(backend.services)[:slow + failing + stuck]
+                for i, short_name in enumerate(names):
+                    backend.services[short_name][2] = 1
+                    statetable[short_name]['ignore_this_service'] = None
+                    statetable[short_name]['expectedstate'] = 'SERVICE_RUNNING'
+                    statetable[short_name]['forceexpectedstate'] = 'yes'
+                    backend.control_delays[short_name] = delay
+                    if (i >= slow + failing):
+                        backend.stuck.add(short_name)
+                    elif (i >= slow):
+                        backend.failing.add(short_name)
+                    detector.invalidate(short_name)
+                enforcer = None
+                if (mode == 'scheduler'):
+                    enforcer = wsm.enforcement_scheduler(backend, max_workers=4, backoff=0.5, backoff_max=2, pending_timeout=1)
+                calls = backend.control_calls
+                worst = 0.0
+                start = time.perf_counter()
+                for i in range(polls):
+                    poll_start = time.perf_counter()
+                    wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, enforcer)
+                    worst = max(worst, time.perf_counter() - poll_start)
+                    time.sleep(interval)
+                elapsed = time.perf_counter() - start - polls * interval
+                running = sum(1 for short_name in names[:slow] if (backend.services[short_name][2] == 4))
+                if (enforcer is not None):
+                    enforcer.close()
+                    stats = enforcer.stats()
+                wsm.log_writer.close()
+                report(mode + ' mean poll', elapsed / polls * 1000, 'ms')
+                report(mode + ' worst poll', worst * 1000, 'ms')
+                report(mode + ' start/stop calls', backend.control_calls - calls, 'calls')
+                report(mode + ' slow services running', running, 'services')
+            finally:
+                wsm.log_writer = None
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    finally:
+        wsm.log_state_transitions_only = saved_mode
+    report('actions completed', stats['ok'], 'actions')
+    report('actions failed', stats['failed'], 'actions')
+    report('actions timed out', stats['timeout'], 'actions')
+    report('skipped while in flight', stats['skipped_in_flight'], 'actions')
+    report('skipped while backing off', stats['skipped_backoff'], 'actions')
+    report('mean action latency', stats['mean_latency_seconds'] * 1000, 'ms')
+    report('max action latency', stats['max_latency_seconds'] * 1000, 'ms')
+    report('mean queue wait', stats['mean_wait_seconds'] * 1000, 'ms')
+    report('max queue wait', stats['max_wait_seconds'] * 1000, 'ms')
+
+""" Mean poll-cycle time with metrics off vs on, plus the cost of taking and
+    exporting one snapshot """
+def bench_metrics(services=10000, churn_rate=0.001, polls=50):
+    print('metrics (' + str(services) + ' services, churn ' + str(churn_rate) + ', ' + str(polls) + ' polls)')
+    for mode in ('off', 'on'):
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+            wsm.metrics = wsm.monitor_metrics() if (mode == 'on') else None
+            backend = wsm.synthetic_scm_backend(services, churn_rate=churn_rate, seed=11)
+            detector = wsm.service_change_detector()
+            statetable = {}
+            wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector)
+            start = time.perf_counter()
+            for i in range(polls):
+                wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector)
+            report('metrics ' + mode + ' mean poll', (time.perf_counter() - start) / polls * 1000, 'ms')
+            if (mode == 'on'):
+                exporter = wsm.metrics_exporter(wsm.metrics, sqlite_dbfile, export='both')
+                start = time.perf_counter()
+                exporter.write()
+                report('snapshot + export (table and file)', (time.perf_counter() - start) * 1000, 'ms')
+                report('exported series', len(wsm.metrics.snapshot()), 'series')
+            wsm.log_writer.close()
+        finally:
+            wsm.log_writer = None
+            wsm.metrics = None
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" synthetic_scm_backend for a remote host, each enum_services() call
+    paying a simulated network round trip.  Its services run as an account
+    of that host, so misrouted registry reads show up in the db """
+class remote_synthetic_backend(wsm.synthetic_scm_backend):
+    def __init__(self, service_count, latency, seed, host=''):
+        wsm.synthetic_scm_backend.__init__(self, service_count, churn_rate=0.001, seed=seed)
+        self.latency = latency
+        self.host = host
+
+    def read_service_key(self, hkey):
+        config = wsm.synthetic_scm_backend.read_service_key(self, hkey)
+        if self.host:
+            config['ObjectName'] = self.host + '\\svc_account'
+        return config
+
+    def enum_services(self):
+        time.sleep(self.latency)
+        return wsm.synthetic_scm_backend.enum_services(self)
+
+""" fleet_collector cycle time (every host polled once) for growing fleets
+    of synthetic hosts with a simulated round trip per enumeration.  The
+    first cycle discovers every service on every host.  Fails if a host's
+    rows hold registry values read from another host """
+def bench_fleet(sizes=(10, 100, 1000), services=100, latency=0.02, cycles=3, workers=16):
+    print('fleet (' + str(services) + ' services per host, ' + str(int(latency * 1000)) + 'ms round trip, ' + str(workers) + ' workers)')
+    for size in sizes:
+        tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+        try:
+            writer = wsm.background_log_writer(sqlite_dbfile, logfile, policy='block')
+            factory = lambda host: wsm.service_metadata_cache(remote_synthetic_backend(services, latency, seed=hash(host) & 0xffff, host=host))
+            hosts = ['host%04d' % i for i in range(size)]
+            fleet = wsm.fleet_collector(hosts, sqlite_dbfile, logfile, writer, factory, max_workers=workers, host_timeout=600)
+            start = time.perf_counter()
+            fleet.run_cycle()
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            for i in range(cycles):
+                fleet.run_cycle()
+            steady = (time.perf_counter() - start) / cycles
+            fleet.stop()
+            writer.close(timeout=600)
+            conn = sqlite3.connect(sqlite_dbfile)
+            host_count, rows = conn.execute("SELECT count(DISTINCT host), count(*) FROM win32service").fetchone()
+            misrouted = conn.execute("SELECT count(*) FROM win32service WHERE ObjectName != host || '\\svc_account'").fetchone()[0]
+            conn.close()
+            require(host_count == size, str(host_count) + ' hosts in db, expected ' + str(size))
+            require(misrouted == 0, str(misrouted) + " rows hold another host's registry values")
+            report(str(size) + ' hosts first cycle', first * 1000, 'ms')
+            report(str(size) + ' hosts steady cycle', steady * 1000, 'ms')
+            report(str(size) + ' hosts serial estimate', size * latency * 1000, 'ms')
+            report(str(size) + ' hosts rows in db', rows, 'rows (' + str(host_count) + ' hosts)')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Wakeups over a simulated hour of run_monitor's poll mode (the old loop
+    woke every second, 3600 times an hour, whatever the interval) and how
+    long a stop request takes to be noticed in real time.  In the busy runs
+    every service is monitored and 1% of them change state per enumeration,
+    so adaptive polling stays at its tightest interval (the worst case).
+    Fails if the wakeups or the stop latency are out of bounds """
+def bench_scheduler(services=300, hours=1, stops=5):
+    print('scheduler (' + str(services) + ' services, ' + str(hours) + ' simulated hour)')
+    report('1 second tick loop wakeups (old)', 3600 * hours, 'wakeups')
+    seconds = hours * 3600
+    limits = {'fixed interval, quiet': seconds / wsm.check_services_interval + 1,
+              'adaptive, quiet': seconds / wsm.check_services_max_interval + seconds / wsm.ignored_services_interval + 10,
+              'fixed interval, busy': seconds / wsm.check_services_interval + 1,
+              'adaptive, busy': seconds / wsm.check_services_min_interval + 1}
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    try:
+        wsm.log_writer = wsm.background_log_writer(sqlite_dbfile, logfile)
+        for label, adaptive, churn_rate in (('fixed interval, quiet', 0, 0.0), ('adaptive, quiet', 1, 0.0),
+                                            ('fixed interval, busy', 0, 0.01), ('adaptive, busy', 1, 0.01)):
+            clock = simulated_clock()
+            wsm.time = clock
+            try:
+                backend = wsm.synthetic_scm_backend(services, churn_rate=churn_rate, seed=13)
+                detector = wsm.service_change_detector()
+                statetable = {}
+                wsm.check_services(statetable, logfile, sqlite_dbfile, backend, detector)
+                if churn_rate:
+                    for svc in statetable.values():
+                        svc['ignore_this_service'] = None
+                end = clock.now + hours * 3600
+                wakeups = [0]
+                def stop_requested(timeout):
+                    wakeups[0] += 1
+                    clock.now += timeout
+                    return (clock.now >= end)
+                wsm.run_monitor(statetable, logfile, sqlite_dbfile, backend, detector, stop_requested,
+                                schedule=wsm.poll_schedule(adaptive=adaptive))
+            finally:
+                wsm.time = time
+            report(label + ' wakeups', wakeups[0], 'wakeups')
+            require(wakeups[0] <= limits[label], label + ': ' + str(wakeups[0]) + ' wakeups, limit ' + str(int(limits[label])))
+        latencies = []
+        for i in range(stops):
+            stop = threading.Event()
+            backend = wsm.synthetic_scm_backend(services, seed=13)
+            monitor = threading.Thread(target=wsm.run_monitor, args=({}, logfile, sqlite_dbfile, backend, wsm.service_change_detector(), stop.wait))
+            monitor.start()
+            time.sleep(random.uniform(0.2, 1.0))
+            require(monitor.is_alive(), 'monitor thread died')
+            start = time.perf_counter()
+            stop.set()
+            monitor.join(5)
+            require(not monitor.is_alive(), 'monitor did not stop within 5s')
+            latencies.append(time.perf_counter() - start)
+        report('mean stop latency', sum(latencies) / stops * 1000, 'ms')
+        report('max stop latency', max(latencies) * 1000, 'ms')
+        require(max(latencies) <= 0.5, 'stop latency ' + ('%.3f' % max(latencies)) + 's, limit 0.5s')
+        wsm.log_writer.close()
+    finally:
+        wsm.log_writer = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Storage per day and reconstruction latency of the service state
+    history over a simulated month of 5 second polls, with a few hundred
+    state changes a day plus the odd install / uninstall """
+def bench_history(services=300, days=30, changes_per_day=500, queries=200):
+    interval = wsm.check_services_interval
+    polls = int(days * 86400 / interval)
+    print('history (' + str(services) + ' services, ' + str(days) + ' days of ' + str(interval) + 's polls, ' + str(changes_per_day) + ' changes/day)')
+    rng = random.Random(14)
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    try:
+        wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+        conn = sqlite3.connect(sqlite_dbfile)
+        empty_bytes = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        conn.close()
+        history = wsm.snapshot_history(sqlite_dbfile)
+        states = dict(('svc%05d' % i, [rng.choice((1, 4))]) for i in range(services))
+        next_id = services
+        start_time = 1700000000
+        change_chance = changes_per_day * interval / 86400.0
+        samples = set(rng.randrange(polls) for i in range(queries))
+        truth = {}
+        start = time.perf_counter()
+        history.record([(name, '', (0x10, state[0])) for name, state in states.items()], [], start_time)
+        for i in range(1, polls):
+            entries = []
+            removed = []
+            if (rng.random() < change_chance):
+                roll = rng.random()
+                if (roll < 0.02):
+                    name = 'svc%05d' % next_id
+                    next_id += 1
+                    states[name] = [4]
+                    entries.append((name, '', (0x10, 4)))
+                elif (roll < 0.04):
+                    name = rng.choice(list(states))
+                    del states[name]
+                    removed.append(name)
+                else:
+                    name = rng.choice(list(states))
+                    state = states[name]
+                    state[0] = 1 if (state[0] == 4) else 4
+                    entries.append((name, '', (0x10, state[0])))
+            taken = start_time + i * interval
+            history.record(entries, removed, taken)
+            if (i in samples):
+                truth[taken] = dict((name, wsm.serviceStates[state[0]]) for name, state in states.items())
+        wsm.log_writer.close()
+        record_seconds = time.perf_counter() - start
+        conn = sqlite3.connect(sqlite_dbfile)
+        rows = conn.execute("SELECT count(*) FROM win32service_history").fetchone()[0]
+        total_bytes = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        conn.close()
+        report('history rows', rows, 'rows')
+        report('encoded delta bytes per day', history.bytes / days, 'bytes')
+        report('db file growth per day', (total_bytes - empty_bytes) / days, 'bytes')
+        report('full snapshot per poll would be', services * (polls / days) * 2, 'bytes/day (2 bytes/service)')
+        report('mean record() time', record_seconds / polls * 1e6, 'us')
+        reader = wsm.snapshot_history_reader(sqlite_dbfile)
+        mismatches = 0
+        latencies = []
+        for taken, expected in truth.items():
+            start = time.perf_counter()
+            state = reader.state_at(taken)
+            latencies.append(time.perf_counter() - start)
+            if (state != expected):
+                mismatches += 1
+        report('state_at() mean latency', sum(latencies) / len(latencies) * 1000, 'ms')
+        report('state_at() max latency', max(latencies) * 1000, 'ms')
+        report('state_at() mismatches', mismatches, 'of ' + str(len(truth)))
+        require(mismatches == 0, str(mismatches) + ' of ' + str(len(truth)) + ' state_at() results differ from the recorded states')
+        start = time.perf_counter()
+        changes = reader.changes(start_time + 86400 * 7, start_time + 86400 * 8)
+        report('changes() over one day', (time.perf_counter() - start) * 1000, 'ms (' + str(len(changes)) + ' changes)')
+        reader.close()
+    finally:
+        wsm.log_writer = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Log file lines/sec appending with open() per line vs log_file_sink
+    (open handle, buffered, JSON records), the cost of rotating with
+    compression, and write time while the disk is full (/dev/full) """
+def bench_log_file(lines=50000):
+    print('log_file (' + str(lines) + ' lines)')
+    tmpdir = tempfile.mkdtemp(prefix='wsm_bench_')
+    try:
+        entry = 'Windows service: svc00042(Synthetic service 42) is SERVICE_STOPPED - not in expectedstate (SERVICE_RUNNING)'
+        logfile = os.path.join(tmpdir, 'per_line.log')
+        start = time.perf_counter()
+        for i in range(lines):
+            F = open(logfile,'a')
+            F.write(entry + '\n')
+            F.close()
+        report('open per line (text)', lines / (time.perf_counter() - start), 'lines/sec')
+        logfile = os.path.join(tmpdir, 'sink.log')
+        sink = wsm.log_file_sink(logfile, rotate_bytes=0)
+        established = wsm.db_timestamp()
+        start = time.perf_counter()
+        for i in range(lines):
+            sink.write(wsm.log_file_line(entry, 'svc00042', established, '', 'out_of_state', 'SERVICE_RUNNING', 'SERVICE_STOPPED'))
+            if ((i % 500) == 0):
+                sink.flush()
+        sink.close()
+        report('log_file_sink (json, buffered)', lines / (time.perf_counter() - start), 'lines/sec')
+        logfile = os.path.join(tmpdir, 'rotating.log')
+        sink = wsm.log_file_sink(logfile, rotate_bytes=1024 * 1024, keep=3)
+        start = time.perf_counter()
+        for i in range(lines):
+            sink.write(wsm.log_file_line(entry, 'svc00042', established, '', 'out_of_state', 'SERVICE_RUNNING', 'SERVICE_STOPPED'))
+        writing = time.perf_counter() - start
+        sink.close()
+        report('rotating every 1MB, keep 3', lines / writing, 'lines/sec')
+        report('rotations / files left', sink.rotations, '/ ' + str(len(os.listdir(tmpdir)) - 2) + ' (incl. current)')
+        if os.path.exists('/dev/full'):
+            saved = wsm.log_error_msg
+            wsm.log_error_msg = lambda msg: None
+            try:
+                sink = wsm.log_file_sink('/dev/full', rotate_bytes=0, buffer_size=4096)
+                start = time.perf_counter()
+                for i in range(lines):
+                    sink.write(entry + '\n')
+                    if ((i % 500) == 0):
+                        sink.flush()
+                elapsed = time.perf_counter() - start
+                sink.close()
+            finally:
+                wsm.log_error_msg = saved
+            report('disk full (/dev/full) write time', elapsed / lines * 1e6, 'us/line')
+            report('disk full lines dropped', sink.dropped, 'lines (' + str(sink.errors) + ' errors)')
+        # the rename fails, like it does on Windows while a viewer has the log open
+        logfile = os.path.join(tmpdir, 'locked.log')
+        sink = wsm.log_file_sink(logfile, rotate_bytes=1024, retry_seconds=3600)
+        saved = (wsm.log_error_msg, wsm.os.replace)
+        wsm.log_error_msg = lambda msg: None
+        def locked(source, target):
+            raise PermissionError('file in use: ' + source)
+        wsm.os.replace = locked
+        try:
+            for i in range(1000):
+                sink.write(wsm.log_file_line(entry, 'svc00042', established))
+            sink.close()
+        finally:
+            wsm.log_error_msg, wsm.os.replace = saved
+        report('rotation blocked, lines written', sink.written, 'of 1000 (' + str(sink.dropped) + ' dropped, ' + str(sink.rotate_failures) + ' failed rotations)')
+        require((sink.written == 1000) and (sink.rotate_failures == 1), 'blocked rotation lost lines or was retried early')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Cost of policy_reloader.check() per cycle with no db writes, after a
+    writer commit without policy edits, and after a bulk edit, against
+    re-reading the whole statetable """
+def bench_policy_reload(services=10000, edits=50, rounds=200):
+    print('policy_reload (' + str(services) + ' services, ' + str(edits) + ' edited)')
+    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+    try:
+        populate_services(sqlite_dbfile, services)
+        writer = wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+        policy = wsm.policy_reloader(sqlite_dbfile)
+        policy.connect()
+        statetable = wsm.read_state_table_from_db_file({}, logfile, sqlite_dbfile)
+        detector = wsm.service_change_detector()
+        start = time.perf_counter()
+        for i in range(rounds):
+            policy.check(statetable, detector, logfile, sqlite_dbfile)
+        report('check(), nothing written', (time.perf_counter() - start) / rounds * 1e6, 'us')
+        elapsed = 0.0
+        for i in range(rounds):
+            writer.log('unrelated log entry', '')
+            writer.flush()
+            start = time.perf_counter()
+            policy.check(statetable, detector, logfile, sqlite_dbfile)
+            elapsed += time.perf_counter() - start
+        report('check(), after an unrelated commit', elapsed / rounds * 1e6, 'us')
+        names = sorted(statetable)[:edits]
+        conn = sqlite3.connect(sqlite_dbfile)
+        with conn:
+            # no edited value, like a db editor would do; the trigger stamps it
+            conn.executemany("UPDATE win32service SET ignore_this_service = NULL, expectedstate = 'SERVICE_RUNNING' WHERE short_name = ?", [(name,) for name in names])
+        conn.close()
+        start = time.perf_counter()
+        changed = policy.check(statetable, detector, logfile, sqlite_dbfile)
+        report('check(), after editing ' + str(edits) + ' services', (time.perf_counter() - start) * 1000, 'ms')
+        applied = sum(1 for name in names if (statetable[name]['ignore_this_service'] is None) and (statetable[name]['expectedstate'] == 'SERVICE_RUNNING'))
+        report('edits applied', applied, 'of ' + str(edits) + ' (' + str(len(changed)) + ' patched)')
+        require(applied == edits, 'only ' + str(applied) + ' of ' + str(edits) + ' policy edits reached the statetable')
+        start = time.perf_counter()
+        wsm.read_state_table_from_db_file({}, logfile, sqlite_dbfile)
+        report('full statetable reload', (time.perf_counter() - start) * 1000, 'ms')
+        policy.close()
+        writer.close()
+    finally:
+        wsm.log_writer = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" synthetic_scm_backend whose registry reads take a simulated
+    RegOpenKey / RegQueryValueEx round trip """
+class slow_registry_backend(wsm.synthetic_scm_backend):
+    def __init__(self, service_count, latency, seed):
+        wsm.synthetic_scm_backend.__init__(self, service_count, seed=seed)
+        self.latency = latency
+
+    def read_service_key(self, hkey):
+        time.sleep(self.latency)
+        return wsm.synthetic_scm_backend.read_service_key(self, hkey)
+
+""" First poll against an empty db, where every service is new: the
+    per-service path vs discover_services(), each without a log writer
+    (a connect/commit per row) and with the background writer SvcDoRun uses.
+    Registry reads take latency seconds each """
+def bench_first_run(sizes=(300, 5000), latency=0.0002):
+    print('first_run (' + str(int(latency * 1e6)) + 'us per registry read, ' + str(wsm.bulk_discovery_workers) + ' workers)')
+    bulk_discovery = wsm.bulk_discovery
+    try:
+        for size in sizes:
+            for bulk in (0, 1):
+                for use_writer in (False, True):
+                    tmpdir, sqlite_dbfile, logfile = make_scratch_db()
+                    try:
+                        wsm.bulk_discovery = bulk
+                        backend = wsm.service_metadata_cache(slow_registry_backend(size, latency, seed=size))
+                        writer = None
+                        if use_writer:
+                            writer = wsm.log_writer = wsm.background_log_writer(sqlite_dbfile, logfile, policy='block')
+                        statetable = wsm.warming_state_table(logfile, sqlite_dbfile)
+                        start = time.perf_counter()
+                        wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, wsm.service_change_detector())
+                        if (writer is not None):
+                            writer.close(timeout=600)
+                            wsm.log_writer = None
+                        elapsed = time.perf_counter() - start
+                        conn = sqlite3.connect(sqlite_dbfile)
+                        services, log_rows = conn.execute("SELECT (SELECT count(*) FROM win32service), (SELECT count(*) FROM win32service_log)").fetchone()
+                        conn.close()
+                        label = str(size) + (' bulk' if bulk else ' per-service') + (', writer' if use_writer else ', no writer')
+                        report(label, elapsed * 1000, 'ms (' + str(services) + ' services, ' + str(log_rows) + ' log rows)')
+                    finally:
+                        wsm.log_writer = None
+                        shutil.rmtree(tmpdir, ignore_errors=True)
+    finally:
+        wsm.bulk_discovery = bulk_discovery
+
+""" Runs the query command line, returns (exit code, stdout lines, stderr) """
+def run_query(sqlite_dbfile, *argv):
+    out = io.StringIO()
+    err = io.StringIO()
+    saved = sys.stderr
+    sys.stderr = err
+    try:
+        code = wsm.query_command_line(['--db', sqlite_dbfile] + list(argv), out)
+    finally:
+        sys.stderr = saved
+    return code, out.getvalue().splitlines(), err.getvalue()
+
+""" Behaviour check of the query command line against a db filled by the
+    monitor: every report, set, the read-only connection (on a path that
+    needs URI quoting) and the refusal to report on an older schema """
+def bench_query_cli(services=20):
+    print('query_cli (' + str(services) + ' services)')
+    tmpdir = tempfile.mkdtemp(prefix='wsm_bench_')
+    try:
+        directory = os.path.join(tmpdir, 'odd name #1?')
+        os.mkdir(directory)
+        sqlite_dbfile = os.path.join(directory, 'w32services.db')
+        logfile = os.path.join(directory, 'w32services.log')
+        wsm.init_w32services_db(sqlite_dbfile)
+        wsm.log_writer = wsm.sqlite_log_writer(sqlite_dbfile, logfile)
+        backend = wsm.synthetic_scm_backend(services, seed=16)
+        detector = wsm.service_change_detector()
+        policy = wsm.policy_reloader(sqlite_dbfile)
+        policy.connect()
+        statetable = {}
+        wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, policy=policy)
+        names = sorted(backend.services)
+
+        code, lines, err = run_query(sqlite_dbfile, 'services')
+        require((code == 0) and (len(lines) == services + 1), 'services: ' + str(len(lines) - 1) + ' rows, expected ' + str(services))
+        require(lines[0].split('\t')[:2] == ['host', 'short_name'], 'services: unexpected header ' + lines[0])
+        code, lines, err = run_query(sqlite_dbfile, 'services', '--like', 'SynthSvc00000%')
+        require(len(lines) == 11, 'services --like: ' + str(len(lines) - 1) + ' rows, expected 10')
+
+        code, lines, err = run_query(sqlite_dbfile, 'set', names[0], names[1], '--ignore', 'none', '--expectedstate', 'running', '--forceexpectedstate', 'none')
+        require((code == 0) and (lines == ['2 rows updated']), 'set: ' + repr(lines) + err)
+        conn = sqlite3.connect(sqlite_dbfile)
+        rows = conn.execute("SELECT short_name, expectedstate, ignore_this_service, edited_by, policy_seq FROM win32service WHERE ignore_this_service IS NULL ORDER BY short_name").fetchall()
+        conn.close()
+        require([row[0] for row in rows] == names[:2], 'set updated ' + repr([row[0] for row in rows]))
+        require(all((row[1] == 'SERVICE_RUNNING') and (row[3] == 'windows_service_monitor_svc.py query') and (row[4] is not None) for row in rows), 'set wrote ' + repr(rows))
+        code, lines, err = run_query(sqlite_dbfile, 'set', names[0])
+        require((code == 1) and ('nothing to set' in err), 'set without columns: ' + repr(code) + err)
+        code, lines, err = run_query(sqlite_dbfile, 'set', names[0], '--expectedstate', 'sideways')
+        require((code == 1) and ('unknown state' in err), 'set with a bad state: ' + repr(code) + err)
+
+        # both edited services stop, the monitor picks up the edit and logs them
+        for short_name in names[:2]:
+            backend.services[short_name][2] = 1
+        for i in range(5):
+            wsm.log_writer.log('filler entry', names[5])
+        wsm.monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, policy=policy)
+        code, lines, err = run_query(sqlite_dbfile, 'out-of-state')
+        require([line.split('\t')[1] for line in lines[1:]] == names[:2], 'out-of-state: ' + repr(lines[1:]))
+        code, lines, err = run_query(sqlite_dbfile, 'changes', '--service', names[0])
+        require(any('not in expectedstate' in line for line in lines[1:]), 'changes --service: ' + repr(lines[1:]))
+        require(all(line.split('\t')[2] == names[0] for line in lines[1:]), 'changes --service returned other services')
+        code, lines, err = run_query(sqlite_dbfile, 'changes', '--limit', '3')
+        require(len(lines) == 4, 'changes --limit 3: ' + str(len(lines) - 1) + ' rows')
+        code, lines, err = run_query(sqlite_dbfile, 'offenders', '--limit', '1')
+        require((len(lines) == 2) and (lines[1].split('\t')[1] == names[5]), 'offenders: ' + repr(lines))
+        wsm.log_writer.close()
+        wsm.log_writer = None
+        policy.close()
+
+        conn = wsm.open_readonly_db(sqlite_dbfile)
+        try:
+            conn.execute("DELETE FROM win32service")
+            require(False, 'read-only connection accepted a write')
+        except sqlite3.OperationalError:
+            pass
+        conn.close()
+
+        conn = sqlite3.connect(sqlite_dbfile)
+        with conn:
+            conn.execute("PRAGMA user_version = 8")
+        schema = conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0]
+        conn.close()
+        code, lines, err = run_query(sqlite_dbfile, 'services')
+        conn = sqlite3.connect(sqlite_dbfile)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        require((conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == schema), 'report changed the schema')
+        conn.close()
+        require((code == 1) and ('schema is older' in err) and (version == 8), 'report on an older schema: ' + repr(code) + ' user_version ' + str(version))
+        print('  all checks passed')
+    finally:
+        wsm.log_writer = None
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+""" Behaviour check of the schema migrator and db maintenance: a db in the
+    original (pre-migration) shape with services and months of log rows is
+    migrated, then one maintenance pass has to prune the old log rows over
+    several log_retention_batch transactions into win32service_log_daily
+    and trim win32service_history to the last keyframe before its cutoff """
+def bench_maintenance(services=50, old_days=10, rows_per_day=1500, recent_rows=500):
+    old_rows = old_days * rows_per_day
+    print('maintenance (' + str(old_rows) + ' log rows past retention, batches of ' + str(wsm.log_retention_batch) + ')')
+    tmpdir = tempfile.mkdtemp(prefix='wsm_bench_')
+    try:
+        sqlite_dbfile = os.path.join(tmpdir, 'w32services.db')
+        logfile = os.path.join(tmpdir, 'w32services.log')
+        conn = sqlite3.connect(sqlite_dbfile)
+        with conn:
+            wsm.migration_base_tables(conn.cursor())
+            conn.executemany("INSERT INTO win32service (short_name, description, laststate, expectedstate, established) VALUES (?, ?, ?, ?, ?)",
+                             [('svc%03d' % i, 'service ' + str(i), 'SERVICE_RUNNING', 'SERVICE_RUNNING', '2020-01-01 00:00:00') for i in range(services)])
+            now = datetime.datetime.now()
+            rows = []
+            for day in range(old_days):
+                established = now - datetime.timedelta(days=wsm.log_retention_days + 1 + day)
+                for i in range(rows_per_day):
+                    rows.append(('svc%03d' % (i % services), 'old entry', (established + datetime.timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S'), 'bench'))
+            for i in range(recent_rows):
+                rows.append(('svc%03d' % (i % services), 'recent entry', (now - datetime.timedelta(hours=1, seconds=i)).strftime('%Y-%m-%d %H:%M:%S'), 'bench'))
+            conn.executemany("INSERT INTO win32service_log (win32service_short_name, logentry, established, established_by) VALUES (?, ?, ?, ?)", rows)
+        conn.close()
+
+        start = time.perf_counter()
+        version = wsm.migrate_w32services_db(sqlite_dbfile)
+        report('migrate baseline db', (time.perf_counter() - start) * 1000, 'ms')
+        conn = sqlite3.connect(sqlite_dbfile)
+        require(version == wsm.schema_migrations[-1][0], 'migrated to version ' + str(version))
+        require(conn.execute("PRAGMA user_version").fetchone()[0] == version, 'user_version not stored')
+        kept = conn.execute("SELECT count(*), count(DISTINCT host), min(host) FROM win32service").fetchone()
+        require(kept == (services, 1, ''), 'services after migration: ' + repr(kept))
+        require(conn.execute("SELECT count(*) FROM win32service_log").fetchone()[0] == old_rows + recent_rows, 'log rows lost in migration')
+
+        # history: two hosts, keyframes either side of the cutoff
+        cutoff = int(time.time()) - wsm.history_retention_days * 86400
+        history = []
+        for host in ('', 'remote'):
+            for offset, keyframe in ((-9 * 86400, 1), (-5 * 86400, 1), (-4 * 86400, 0), (-2 * 86400, 1), (-86400, 0), (3600, 0), (86400, 1)):
+                history.append((host, cutoff + offset, keyframe, b''))
+        with conn:
+            conn.executemany(wsm.insert_history_sql, history)
+        conn.close()
+
+        maintenance = wsm.db_maintenance_thread(sqlite_dbfile, logfile)
+        start = time.perf_counter()
+        maintenance.maintain()
+        report('maintenance pass', (time.perf_counter() - start) * 1000, 'ms')
+        conn = sqlite3.connect(sqlite_dbfile)
+        remaining_old = conn.execute("SELECT count(*) FROM win32service_log WHERE logentry = 'old entry'").fetchone()[0]
+        remaining_recent = conn.execute("SELECT count(*) FROM win32service_log WHERE logentry = 'recent entry'").fetchone()[0]
+        summarized, days = conn.execute("SELECT sum(entries), count(DISTINCT day) FROM win32service_log_daily").fetchone()
+        per_service = conn.execute("SELECT min(total), max(total) FROM (SELECT sum(entries) AS total FROM win32service_log_daily GROUP BY win32service_short_name)").fetchone()
+        history_left = conn.execute("SELECT host, taken - ? FROM win32service_history ORDER BY host, taken", (cutoff,)).fetchall()
+        conn.close()
+        report('old log rows left', remaining_old, 'rows')
+        report('rows in win32service_log_daily', summarized, 'entries over ' + str(days) + ' days')
+        require((remaining_old == 0) and (remaining_recent == recent_rows), 'pruned wrong rows: ' + str(remaining_old) + ' old / ' + str(remaining_recent) + ' recent left')
+        require(summarized == old_rows, 'daily summary holds ' + str(summarized) + ' entries, pruned ' + str(old_rows))
+        require(per_service == (old_rows // services, old_rows // services), 'per service summary ' + repr(per_service))
+        expected = [(host, offset) for host in ('', 'remote') for offset in (-2 * 86400, -86400, 3600, 86400)]
+        require(history_left == expected, 'history after pruning ' + repr(history_left))
+        print('  all checks passed')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+benchmarks = {
+    'log_writer': bench_log_writer,
+    'background_writer': bench_background_writer,
+    'poll_cycle': bench_poll_cycle,
+    'change_detection': bench_change_detection,
+    'notifications': bench_notifications,
+    'metadata_cache': bench_metadata_cache,
+    'cold_start': bench_cold_start,
+    'log_spam': bench_log_spam,
+    'enforcement': bench_enforcement,
+    'metrics': bench_metrics,
+    'fleet': bench_fleet,
+    'scheduler': bench_scheduler,
+    'history': bench_history,
+    'log_file': bench_log_file,
+    'policy_reload': bench_policy_reload,
+    'first_run': bench_first_run,
+    'query_cli': bench_query_cli,
+    'maintenance': bench_maintenance,
+    }
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -56,90 +56,714 @@ Navigate to windows services, adjust service to start on start-up!
 #sqlite_dbfile = 'C:\\scripts\\w32services.db'
 #logfile = 'C:\\scripts\\w32services.log'
 check_services_interval = 5     # in seconds
+adaptive_polling = 1            # tighten the poll interval after changes, back off when quiet
+check_services_min_interval = 1     # in seconds, poll interval right after a change
+check_services_max_interval = 30    # in seconds, poll interval after a long quiet spell
+poll_backoff = 1.5              # interval growth per quiet poll
+ignored_services_interval = 300 # in seconds, state changes of ignored services are recorded this often
+metadata_refresh_interval = 300 # in seconds, between checks of known services' ImagePath / ObjectName, 0 never
 logging = 1                     # only for debugging
+log_batch_size = 500            # queued db log rows that force a flush
+log_flush_interval = 5          # in seconds, max age of queued db log rows
+log_file_format = 'json'        # 'json' (one record per line) or 'text'
+log_rotate_bytes = 50 * 1024 * 1024     # rotate the log file past this size, 0 never
+log_rotate_days = 7             # rotate the log file after this many days, 0 never
+log_rotate_keep = 10            # rotated log files kept
+log_rotate_compress = 1         # gzip rotated log files
+log_queue_size = 10000          # events buffered for the background writer
+log_queue_policy = 'drop_oldest'    # when full: 'block', 'drop_oldest' or 'drop_newest'
+monitor_mode = 'poll'           # 'poll' every check_services_interval, or 'notify' on SCM events
+reconcile_interval = 300        # in seconds, full check between events in 'notify' mode
+lazy_statetable_load = 1        # start polling while the statetable loads in the background
+bulk_discovery = 1              # first run on an empty db imports every service in one pass
+bulk_discovery_workers = 8      # registry lookups run at once during bulk discovery
+log_retention_days = 90         # win32service_log rows older than this are pruned, 0 keeps all
+log_retention_policy = 'summarize'  # 'summarize' into win32service_log_daily, or 'delete'
+log_retention_batch = 5000      # log rows pruned per transaction
+maintenance_interval = 3600     # in seconds, between db maintenance passes
+incremental_vacuum_pages = 2000 # free pages returned to the filesystem per pass
+convert_auto_vacuum = 0         # at service start, convert a db created without incremental auto_vacuum (one full VACUUM, slow on a large db)
+log_state_transitions_only = 1  # log out-of-state services on change, not on every poll
+out_of_state_rollup_interval = 900  # in seconds, between "still out of state" records
+enforcement_workers = 4         # start/stop actions allowed to run at once
+enforcement_backoff = 30        # in seconds, retry delay after a failed action (doubles each time)
+enforcement_backoff_max = 3600  # in seconds, cap on the retry delay
+enforcement_pending_timeout = 120   # in seconds, wait for a service to leave START/STOP_PENDING
+metrics_interval = 60           # in seconds, between metrics snapshots (0 turns metrics off)
+metrics_export = 'table'        # 'table' (win32service_metrics), 'prometheus' (text file) or 'both'
+metrics_file = ''               # prometheus text file, defaults to the db file name with .prom
+snapshot_history_enabled = 1    # keep a compact per-poll history of service states
+history_keyframe_interval = 3600    # in seconds, between full snapshots in the history
+history_retention_days = 31     # history older than this is pruned, 0 keeps all
+fleet_hosts = []                # remote machines polled by fleet_collector, empty for this machine only
+fleet_workers = 16              # hosts polled at once
+fleet_host_timeout = 30         # in seconds, a host poll running longer is reported as timed out
+fleet_jitter = 0.1              # fraction of check_services_interval each host's schedule is jittered by
 
-import win32event
-import win32api
-import win32con
-import win32service
-import win32serviceutil
-import servicemanager
 import os
 import sqlite3
 import datetime
 import time
 import sys
 import socket
+import queue
+import threading
+import random
+import ctypes
+import re
+import concurrent.futures
+import json
+import gzip
+import shutil
+import argparse
+import urllib.request
 
+# pywin32 is only needed to run as a service / talk to a live SCM.  Without
+# it the module still imports, so the synthetic backend and the benchmarks
+# run on any platform.
+try:
+    import win32event
+    import win32api
+    import win32con
+    import win32service
+    import win32serviceutil
+    import servicemanager
+except ImportError:
+    win32event = win32api = win32con = win32service = win32serviceutil = servicemanager = None
 
-""" Setup some constants in dictionaries from win32service """
+
+""" Setup some constants in dictionaries from win32service
+    (values copied from winsvc.h so they don't need pywin32 at import time) """
 serviceStates = {0:'Unknown',
-                 win32service.SERVICE_STOP:'SERVICE_STOP',
-                 win32service.SERVICE_STOPPED:'SERVICE_STOPPED',
-                 win32service.SERVICE_START_PENDING:'SERVICE_START_PENDING',
-                 win32service.SERVICE_START:'SERVICE_START',
-                 win32service.SERVICE_RUNNING:'SERVICE_RUNNING'
+                 0x20:'SERVICE_STOP',               # win32service.SERVICE_STOP
+                 1:'SERVICE_STOPPED',               # win32service.SERVICE_STOPPED
+                 2:'SERVICE_START_PENDING',         # win32service.SERVICE_START_PENDING
+                 3:'SERVICE_STOP_PENDING',          # win32service.SERVICE_STOP_PENDING
+                 0x10:'SERVICE_START',              # win32service.SERVICE_START
+                 4:'SERVICE_RUNNING',               # win32service.SERVICE_RUNNING
+                 5:'SERVICE_CONTINUE_PENDING',      # win32service.SERVICE_CONTINUE_PENDING
+                 6:'SERVICE_PAUSE_PENDING',         # win32service.SERVICE_PAUSE_PENDING
+                 7:'SERVICE_PAUSED'                 # win32service.SERVICE_PAUSED
                  }
 serviceTypes = {0:'Unknown',
-                win32service.SERVICE_KERNEL_DRIVER:'SERVICE_KERNEL_DRIVER',
-                win32service.SERVICE_FILE_SYSTEM_DRIVER:'SERVICE_FILE_SYSTEM_DRIVER',
-                win32service.SERVICE_INTERACTIVE_PROCESS:'SERVICE_INTERACTIVE_PROCESS',
-                win32service.SERVICE_DRIVER:'SERVICE_DRIVER',
-                win32service.SERVICE_WIN32:'SERVICE_WIN32',
-                win32service.SERVICE_WIN32_OWN_PROCESS:'SERVICE_WIN32_OWN_PROCESS',
-                win32service.SERVICE_WIN32_SHARE_PROCESS:'SERVICE_WIN32_SHARE_PROCESS'  
+                1:'SERVICE_KERNEL_DRIVER',          # win32service.SERVICE_KERNEL_DRIVER
+                2:'SERVICE_FILE_SYSTEM_DRIVER',     # win32service.SERVICE_FILE_SYSTEM_DRIVER
+                0x100:'SERVICE_INTERACTIVE_PROCESS',    # win32service.SERVICE_INTERACTIVE_PROCESS
+                0x0b:'SERVICE_DRIVER',              # win32service.SERVICE_DRIVER
+                0x30:'SERVICE_WIN32',               # win32service.SERVICE_WIN32
+                0x10:'SERVICE_WIN32_OWN_PROCESS',   # win32service.SERVICE_WIN32_OWN_PROCESS
+                0x20:'SERVICE_WIN32_SHARE_PROCESS'  # win32service.SERVICE_WIN32_SHARE_PROCESS
                 }
 
-""" Tries to write to log file + db log table """
-def write_to_log(logentry, service_short_name, logfile, sqlite_dbfile):
+""" Reports an error to the windows event log, or stderr without pywin32 """
+def log_error_msg(msg):
+    if (servicemanager is not None):
+        servicemanager.LogErrorMsg(msg)
+    else:
+        sys.stderr.write(msg + '\n')
+
+""" Parameterized statements shared by the per-line and batched db writers """
+insert_log_sql = "INSERT INTO win32service_log "
+insert_log_sql += "(win32service_short_name, logentry, established, established_by, host) "
+insert_log_sql += "VALUES (?, ?, ?, ?, ?)"
+
+insert_service_sql = "INSERT INTO win32service (short_name, description, laststate, "
+insert_service_sql += "expectedstate, servicetype, ImagePath, ObjectName, established, "
+insert_service_sql += "established_by, ignore_this_service, host) "
+insert_service_sql += "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+update_service_sql = "UPDATE win32service SET laststate = ?, inactivated = ?, inactivated_by = ? "
+update_service_sql += "WHERE short_name = ? AND host = ?"
+
+update_config_sql = "UPDATE win32service SET ImagePath = ?, ObjectName = ? "
+update_config_sql += "WHERE short_name = ? AND host = ?"
+
+""" win32service_state_summary rows are applied as deltas:
+    (short_name, out_of_state_count, out_of_state_seconds, polls_out_of_state,
+     last_out_of_state, last_back_in_state), NULL timestamps are left alone.
+    Every table is keyed by host as well, '' being the local machine """
+insert_summary_sql = "INSERT OR IGNORE INTO win32service_state_summary (win32service_short_name, host) VALUES (?, ?)"
+
+update_summary_sql = "UPDATE win32service_state_summary SET "
+update_summary_sql += "out_of_state_count = out_of_state_count + ?, "
+update_summary_sql += "out_of_state_seconds = out_of_state_seconds + ?, "
+update_summary_sql += "polls_out_of_state = polls_out_of_state + ?, "
+update_summary_sql += "last_out_of_state = COALESCE(?, last_out_of_state), "
+update_summary_sql += "last_back_in_state = COALESCE(?, last_back_in_state) "
+update_summary_sql += "WHERE win32service_short_name = ? AND host = ?"
+
+""" Set by SvcDoRun to the running sqlite_log_writer; while it is set
+    write_to_log() and add_new_service_to_db() queue rows on it instead of
+    opening a connection per call """
+log_writer = None
+
+""" Per-thread override of log_writer.  fleet_collector points it at a
+    host_log_writer while check_services() runs for a remote host, so the
+    rows it writes are tagged with that host """
+writer_context = threading.local()
+
+def active_log_writer():
+    return getattr(writer_context, 'writer', None) or log_writer
+
+""" Set by SvcDoRun to a monitor_metrics when metrics_interval > 0.  Every
+    instrumented spot checks it for None first, so with metrics off the only
+    cost is that check """
+metrics = None
+
+insert_history_name_sql = "INSERT OR IGNORE INTO win32service_history_names (host, name_id, short_name) VALUES (?, ?, ?)"
+
+insert_history_sql = "INSERT INTO win32service_history (host, taken, keyframe, delta) VALUES (?, ?, ?, ?)"
+
+""" Local time in the same format as sqlite's datetime('now','localtime') """
+def db_timestamp():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+""" One log file line.  With log_file_format = 'json' a record of
+    timestamp, host, service, event type, old / new state and the message,
+    otherwise the timestamp, host and message as text """
+def log_file_line(logentry, service_short_name, established, host='', event=None, old_state=None, new_state=None):
+    if (log_file_format == 'json'):
+        return json.dumps({'ts': established, 'host': host, 'service': service_short_name,
+                           'event': event or 'message', 'old_state': old_state,
+                           'new_state': new_state, 'message': logentry}) + '\n'
+    return established + ' : ' + ((host + ' : ') if host else '') + logentry + '\n'
+
+""" Tries to write to log file + db log table.  event (e.g. 'out_of_state',
+    'discovered', 'enforcement') and old_state / new_state only go to the
+    structured log file """
+def write_to_log(logentry, service_short_name, logfile, sqlite_dbfile, event=None, old_state=None, new_state=None):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.log(logentry, service_short_name, event=event, old_state=old_state, new_state=new_state)
+        return
+    established = db_timestamp()
     try:
         F = open(logfile,'a')
-        F.write(logentry + '\n')
+        F.write(log_file_line(logentry, service_short_name, established, '', event, old_state, new_state))
         F.close()    
     except:
-        servicemanager.LogErrorMsg("Error, cannot open logfile: " + logfile)
+        log_error_msg("Error, cannot open logfile: " + logfile)
     try:    
         conn = sqlite3.connect(sqlite_dbfile)
         c = conn.cursor()
-        
-        sql = "INSERT INTO win32service_log "
-        sql += "(win32service_short_name, logentry, established, established_by) "
-        sql += " VALUES ("
-        sql += "'" + service_short_name + "', "
-        sql += "'" + logentry + "', "
-        sql += "" + "datetime('now','localtime')" + ", "
-        sql += "'" + "windows_service_monitor_svc.py" + "')"
-        
-        c.execute(sql)
+        c.execute(insert_log_sql, (service_short_name, logentry, established, "windows_service_monitor_svc.py", ''))
         conn.commit()
         conn.close()
     except:
-        servicemanager.LogErrorMsg("Error, cannot add log entry to db: " + sqlite_dbfile)
+        log_error_msg("Error, cannot add log entry to db: " + sqlite_dbfile)
 
-""" Checks windows registry keys for values to use for sqlite_dbfile and logfile """
-def init_local_vars():
-    # sqlite_dbfile is in HKEY_LOCAL_MACHINE\SYSTEM\CurrentControlSet\services\Windows Service Monitor    
+""" Row tuple for insert_service_sql built from a new_svc dict """
+def new_service_row(new_svc, established=None, host=''):
+    return (new_svc['service_short_name'],
+            new_svc['service_description'],
+            new_svc['laststate'],
+            new_svc['expectedstate'],
+            str(new_svc['servicetype']),
+            str(new_svc['ImagePath']).replace('"', ''),
+            str(new_svc['ObjectName']),
+            established or db_timestamp(),
+            "windows_service_monitor",
+            new_svc['ignore_this_service'],
+            host)
+
+""" Log file writer owned by sqlite_log_writer.  Keeps the file open with a
+    buffer that flush() empties once per poll cycle, and rotates it once it
+    passes rotate_bytes or its first record is rotate_days old, across
+    service restarts (files without a readable first timestamp go by their
+    creation time): the file is renamed
+    with a timestamp suffix, gzipped on a separate thread and only the
+    newest keep rotated files are kept.  A failed rename (the file open in
+    a viewer) leaves the file in place and is retried after retry_seconds.
+    A write or flush error (disk full,
+    file locked) drops the buffered lines, and lines are then dropped and
+    counted for retry_seconds before the file is reopened, so a bad disk
+    never stalls the writer """
+class log_file_sink:
+    def __init__(self, logfile, rotate_bytes=log_rotate_bytes, rotate_days=log_rotate_days,
+                 keep=log_rotate_keep, compress=log_rotate_compress, retry_seconds=60, buffer_size=65536):
+        self.logfile = logfile
+        self.rotate_bytes = rotate_bytes
+        self.rotate_days = rotate_days
+        self.keep = keep
+        self.compress = compress
+        self.retry_seconds = retry_seconds
+        self.buffer_size = buffer_size
+        self.file = None
+        self.size = 0
+        self.started = 0.0
+        self.retry_after = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.rotations = 0
+        self.rotate_failures = 0
+        self.rotate_after = 0.0
+        self.compressors = []
+
+    def open(self):
+        self.file = open(self.logfile, 'a', buffering=self.buffer_size, encoding='utf-8')
+        self.size = self.file.tell()
+        self.started = self.file_started() if self.size else time.time()
+
+    """ When the current log file was started, from the timestamp of its
+        first record, else the file's creation time """
+    def file_started(self):
+        try:
+            with open(self.logfile, 'r', encoding='utf-8') as F:
+                first = F.readline(4096)
+        except (OSError, ValueError):
+            first = ''
+        try:
+            if first.startswith('{'):
+                established = json.loads(first)['ts']
+            else:
+                established = first[:19]
+            return time.mktime(time.strptime(established, '%Y-%m-%d %H:%M:%S'))
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            stat = os.stat(self.logfile)
+        except OSError:
+            return time.time()
+        return getattr(stat, 'st_birthtime', stat.st_ctime)
+
+    def write(self, line):
+        if (self.file is None):
+            if (time.monotonic() < self.retry_after):
+                self.dropped += 1
+                return
+            try:
+                self.open()
+            except OSError:
+                self.failed()
+                self.dropped += 1
+                return
+        try:
+            self.file.write(line)
+        except OSError:
+            self.failed()
+            self.dropped += 1
+            return
+        self.written += 1
+        self.size += len(line)
+        if (self.rotate_bytes and (self.size >= self.rotate_bytes)) or (self.rotate_days and ((time.time() - self.started) >= (self.rotate_days * 86400))):
+            if (time.monotonic() >= self.rotate_after):
+                self.rotate()
+
+    def flush(self):
+        if (self.file is None):
+            return
+        try:
+            self.file.flush()
+        except OSError:
+            self.failed()
+
+    def failed(self):
+        self.errors += 1
+        log_error_msg("Error, cannot write logfile: " + self.logfile + ", dropping lines for " + str(self.retry_seconds) + "s")
+        if (self.file is not None):
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        self.retry_after = time.monotonic() + self.retry_seconds
+
+    def rotate(self):
+        try:
+            self.file.close()
+        except OSError:
+            self.failed()
+            return
+        self.file = None
+        rotated = self.logfile + '.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = self.logfile + '.' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '-' + str(suffix)
+            suffix += 1
+        try:
+            os.replace(self.logfile, rotated)
+        except OSError:
+            # e.g. the log is open in a viewer: keep appending to it and
+            # try the rotation again after retry_seconds
+            self.rotate_failures += 1
+            self.rotate_after = time.monotonic() + self.retry_seconds
+            log_error_msg("Error, cannot rotate logfile: " + self.logfile + ", retrying in " + str(self.retry_seconds) + "s")
+            try:
+                self.open()
+            except OSError:
+                self.failed()
+            return
+        self.rotations += 1
+        if self.compress:
+            compressor = threading.Thread(target=self.compress_file, args=(rotated,), name="log_file_compressor")
+            compressor.daemon = True
+            compressor.start()
+            self.compressors = [thread for thread in self.compressors if thread.is_alive()] + [compressor]
+        else:
+            self.remove_old()
+
+    def compress_file(self, rotated):
+        try:
+            with open(rotated, 'rb') as source, gzip.open(rotated + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+        except OSError:
+            log_error_msg("Error, cannot compress rotated logfile: " + rotated)
+        self.remove_old()
+
+    def remove_old(self):
+        directory = os.path.dirname(os.path.abspath(self.logfile))
+        prefix = os.path.basename(self.logfile) + '.'
+        rotated = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name[len(prefix):len(prefix) + 1].isdigit())
+        for name in rotated[:max(0, len(rotated) - self.keep)]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def close(self):
+        self.flush()
+        if (self.file is not None):
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        for thread in self.compressors:
+            thread.join()
+
+""" Long-lived db writer owned by SvcDoRun.  Keeps one WAL mode connection
+    open and queues win32service_log / win32service rows, which flush() sends
+    with executemany in a single transaction.  flush() is called once per
+    poll cycle, and log() flushes early once batch_size rows are queued or
+    the oldest queued row is older than flush_interval seconds """
+class sqlite_log_writer:
+    def __init__(self, sqlite_dbfile, logfile, batch_size=log_batch_size, flush_interval=log_flush_interval):
+        self.sqlite_dbfile = sqlite_dbfile
+        self.logfile = logfile
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log_rows = []
+        self.service_rows = []
+        self.update_rows = []
+        self.config_rows = []
+        self.summary_rows = []
+        self.history_rows = []
+        self.name_rows = []
+        self.first_queued = None
+        self.retry_at = None
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        self.sink = log_file_sink(logfile)
+        self.conn = sqlite3.connect(sqlite_dbfile)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def log(self, logentry, service_short_name, established=None, host='', event=None, old_state=None, new_state=None):
+        established = established or db_timestamp()
+        self.sink.write(log_file_line(logentry, service_short_name, established, host, event, old_state, new_state))
+        self.log_rows.append((service_short_name, logentry, established, "windows_service_monitor_svc.py", host))
+        self.queued()
+
+    def add_service(self, new_svc, established=None, host=''):
+        self.service_rows.append(new_service_row(new_svc, established, host))
+        self.queued()
+
+    def add_services(self, new_svcs, established=None, host=''):
+        established = established or db_timestamp()
+        self.service_rows.extend(new_service_row(new_svc, established, host) for new_svc in new_svcs)
+        self.queued()
+
+    def update_services(self, rows, host=''):
+        self.update_rows.extend(row + (host,) for row in rows)
+        self.queued()
+
+    def update_service_config(self, rows, host=''):
+        self.config_rows.extend(row + (host,) for row in rows)
+        self.queued()
+
+    def update_state_summary(self, rows, host=''):
+        self.summary_rows.extend(row + (host,) for row in rows)
+        self.queued()
+
+    def add_history(self, rows, names):
+        self.history_rows.extend(rows)
+        self.name_rows.extend(names)
+        self.queued()
+
+    def pending(self):
+        return len(self.log_rows) + len(self.service_rows) + len(self.update_rows) + len(self.config_rows) + len(self.summary_rows) + len(self.history_rows)
+
+    def queued(self):
+        if (self.first_queued is None):
+            self.first_queued = time.time()
+        if ((self.retry_at is not None) and (time.time() < self.retry_at)):
+            return
+        if (self.pending() >= self.batch_size):
+            self.flush()
+        elif ((time.time() - self.first_queued) >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.sink.flush()
+        if (self.pending() == 0):
+            return
+        # after a failed flush the db is retried once per flush_interval
+        if ((self.retry_at is not None) and (time.time() < self.retry_at)):
+            return
+        if (metrics is not None):
+            started = time.perf_counter()
+            metrics.count('db_rows_written', self.pending())
+        try:
+            with self.conn:
+                if self.service_rows:
+                    self.conn.executemany(insert_service_sql, self.service_rows)
+                if self.update_rows:
+                    self.conn.executemany(update_service_sql, self.update_rows)
+                if self.config_rows:
+                    self.conn.executemany(update_config_sql, self.config_rows)
+                if self.summary_rows:
+                    self.conn.executemany(insert_summary_sql, [(row[0], row[6]) for row in self.summary_rows])
+                    self.conn.executemany(update_summary_sql, [row[1:6] + (row[0], row[6]) for row in self.summary_rows])
+                if self.log_rows:
+                    self.conn.executemany(insert_log_sql, self.log_rows)
+                if self.name_rows:
+                    self.conn.executemany(insert_history_name_sql, self.name_rows)
+                if self.history_rows:
+                    self.conn.executemany(insert_history_sql, self.history_rows)
+        except:
+            self.failed_flushes += 1
+            log_error_msg("Error, cannot flush " + str(len(self.log_rows)) + " log entries to db: " + self.sqlite_dbfile)
+            if (metrics is not None):
+                metrics.count('db_write_errors')
+            # keep the rows for the next flush unless the db has been
+            # unavailable for long enough to build up a large backlog
+            if (self.pending() < (self.batch_size * 10)):
+                self.retry_at = time.time() + self.flush_interval
+                return
+            self.dropped_rows += self.pending()
+            log_error_msg("Error, dropped " + str(self.pending()) + " rows queued for db: " + self.sqlite_dbfile)
+            if (metrics is not None):
+                metrics.count('db_rows_dropped', self.pending())
+        self.retry_at = None
+        self.log_rows = []
+        self.service_rows = []
+        self.update_rows = []
+        self.config_rows = []
+        self.summary_rows = []
+        self.history_rows = []
+        self.name_rows = []
+        self.first_queued = None
+        if (metrics is not None):
+            metrics.observe('db_write', time.perf_counter() - started)
+
+    def close(self):
+        self.retry_at = None
+        self.flush()
+        self.sink.close()
+        try:
+            self.conn.close()
+        except:
+            pass
+
+""" Runs a sqlite_log_writer on its own thread so that log file and db I/O
+    never stretch a poll cycle.  The poller only puts events on a bounded
+    queue; when the queue is full log_queue_policy decides whether the poller
+    waits ('block') or an event is dropped and counted.  close() drains the
+    queue and flushes before the thread exits """
+class background_log_writer:
+    stop_marker = ('stop',)
+    flush_marker = ('flush',)
+
+    def __init__(self, sqlite_dbfile, logfile, queue_size=log_queue_size, policy=log_queue_policy):
+        self.sqlite_dbfile = sqlite_dbfile
+        self.logfile = logfile
+        self.policy = policy
+        self.events = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.max_queue_depth = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.writer = None
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="background_log_writer")
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+        if (self.error is not None):
+            raise self.error
+
+    def log(self, logentry, service_short_name, host='', event=None, old_state=None, new_state=None):
+        self.put(('log', logentry, service_short_name, db_timestamp(), host, event, old_state, new_state))
+
+    def add_service(self, new_svc, host=''):
+        self.put(('service', dict(new_svc), db_timestamp(), host))
+
+    def add_services(self, new_svcs, host=''):
+        self.put(('services', [dict(new_svc) for new_svc in new_svcs], db_timestamp(), host))
+
+    def update_services(self, rows, host=''):
+        self.put(('update', list(rows), host))
+
+    def update_service_config(self, rows, host=''):
+        self.put(('config', list(rows), host))
+
+    def update_state_summary(self, rows, host=''):
+        self.put(('summary', list(rows), host))
+
+    def add_history(self, rows, names):
+        self.put(('history', rows, names))
+
+    def flush(self):
+        self.put(self.flush_marker)
+
+    def put(self, event):
+        with self.lock:
+            depth = self.events.qsize() + 1
+            if (depth > self.max_queue_depth):
+                self.max_queue_depth = depth
+            self.enqueued += 1
+        if (self.policy == 'block'):
+            self.events.put(event)
+            return
+        try:
+            self.events.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+        with self.lock:
+            self.dropped += 1
+        if (self.policy == 'drop_oldest'):
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+
+    def run(self):
+        try:
+            self.writer = sqlite_log_writer(self.sqlite_dbfile, self.logfile)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        while True:
+            try:
+                event = self.events.get(timeout=self.writer.flush_interval)
+            except queue.Empty:
+                event = self.flush_marker
+            if (event is self.stop_marker):
+                break
+            start = time.perf_counter()
+            if (event[0] == 'log'):
+                self.writer.log(*event[1:])
+            elif (event[0] == 'service'):
+                self.writer.add_service(event[1], event[2], event[3])
+            elif (event[0] == 'services'):
+                self.writer.add_services(event[1], event[2], event[3])
+            elif (event[0] == 'update'):
+                self.writer.update_services(event[1], event[2])
+            elif (event[0] == 'config'):
+                self.writer.update_service_config(event[1], event[2])
+            elif (event[0] == 'summary'):
+                self.writer.update_state_summary(event[1], event[2])
+            elif (event[0] == 'history'):
+                self.writer.add_history(event[1], event[2])
+            else:
+                self.writer.flush()
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                if (event[0] != 'flush'):
+                    self.written += 1
+                self.write_seconds += elapsed
+                if (elapsed > self.max_write_seconds):
+                    self.max_write_seconds = elapsed
+        self.writer.close()
+
+    """ Snapshot of the writer counters """
+    def stats(self):
+        with self.lock:
+            return {'queue_depth': self.events.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'enqueued': self.enqueued,
+                    'dropped': self.dropped,
+                    'written': self.written,
+                    'failed_flushes': self.writer.failed_flushes if self.writer else 0,
+                    'db_rows_dropped': self.writer.dropped_rows if self.writer else 0,
+                    'write_seconds': self.write_seconds,
+                    'max_write_seconds': self.max_write_seconds}
+
+    def close(self, timeout=30):
+        self.events.put(self.stop_marker)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            log_error_msg("Log writer did not drain within " + str(timeout) + "s, " + str(self.events.qsize()) + " events lost")
+
+""" Tags everything written through it with host and forwards it to a
+    shared background_log_writer.  One per host in fleet_collector """
+class host_log_writer:
+    def __init__(self, writer, host):
+        self.writer = writer
+        self.host = host
+
+    def log(self, logentry, service_short_name, event=None, old_state=None, new_state=None):
+        self.writer.log(logentry, service_short_name, self.host, event, old_state, new_state)
+
+    def add_service(self, new_svc):
+        self.writer.add_service(new_svc, self.host)
+
+    def add_services(self, new_svcs):
+        self.writer.add_services(new_svcs, self.host)
+
+    def update_services(self, rows):
+        self.writer.update_services(rows, self.host)
+
+    def update_service_config(self, rows):
+        self.writer.update_service_config(rows, self.host)
+
+    def update_state_summary(self, rows):
+        self.writer.update_state_summary(rows, self.host)
+
+    def add_history(self, rows, names):
+        self.writer.add_history(rows, names)
+
+    def flush(self):
+        self.writer.flush()
+
+""" Reads one setting (sqlite_dbfile, logfile) from
+    HKEY_LOCAL_MACHINE\SYSTEM\CurrentControlSet\services\Windows Service Monitor,
+    None when it can't be read.  Touches nothing else """
+def read_registry_setting(value_name):
     access = win32con.KEY_READ | win32con.KEY_ENUMERATE_SUB_KEYS | win32con.KEY_QUERY_VALUE
     hkey_base = "SYSTEM\\CurrentControlSet\\Services"
     hkey_key = "\\" + "Windows Service Monitor"
     try:
         hkey = win32api.RegOpenKey(win32con.HKEY_LOCAL_MACHINE, (hkey_base + hkey_key), 0, access)
-        regkey = str(win32api.RegQueryValueEx(hkey, "sqlite_dbfile")[0])
-        sqlite_dbfile = regkey
+        try:
+            return str(win32api.RegQueryValueEx(hkey, value_name)[0])
+        finally:
+            win32api.RegCloseKey(hkey)
     except:
-        servicemanager.LogErrorMsg("Cannot open regkey: " + hkey_base + hkey_key + "\\sqlite_dbfile")
+        log_error_msg("Cannot open regkey: " + hkey_base + hkey_key + "\\" + value_name)
+        return None
+
+""" Checks windows registry keys for values to use for sqlite_dbfile and logfile """
+def init_local_vars():
+    sqlite_dbfile = read_registry_setting("sqlite_dbfile")
+    if (sqlite_dbfile is None):
         return "", "", 0
-    
-    # logfile is in HKEY_LOCAL_MACHINE\SYSTEM\CurrentControlSet\services\Windows Service Monitor    
-    access = win32con.KEY_READ | win32con.KEY_ENUMERATE_SUB_KEYS | win32con.KEY_QUERY_VALUE
-    hkey_base = "SYSTEM\\CurrentControlSet\\Services"
-    hkey_key = "\\" + "Windows Service Monitor"
-    try:
-        hkey = win32api.RegOpenKey(win32con.HKEY_LOCAL_MACHINE, (hkey_base + hkey_key), 0, access)
-        regkey = str(win32api.RegQueryValueEx(hkey, "logfile")[0])
-        logfile = regkey
-    except:
-        servicemanager.LogErrorMsg("Cannot open regkey: " + hkey_base + hkey_key + "\\logfile")
+    logfile = read_registry_setting("logfile")
+    if (logfile is None):
         return "", "", 0
     
     # Verify sqlite_dbfile exists, if not, initialize
@@ -148,15 +772,16 @@ def init_local_vars():
         fh.close()
         # Store configuration file values
     except:
-        servicemanager.LogErrorMsg("sqlite_dbfile does not exist!  Attempting to initialize new file")
-        init_w32services_db(sqlite_dbfile)
+        log_error_msg("sqlite_dbfile does not exist!  Attempting to initialize new file")
+    # Safe to run on an existing file too, brings older schemas up to date
+    init_w32services_db(sqlite_dbfile)
     try:
         conn = sqlite3.connect(sqlite_dbfile)
         c = conn.cursor()
         conn.close()
         # Store configuration file values
     except:
-        servicemanager.LogErrorMsg("Cannot initialize/open sqlite_dbfile: " + sqlite_dbfile)
+        log_error_msg("Cannot initialize/open sqlite_dbfile: " + sqlite_dbfile)
         return "", "", 0
     
     # Verify we can write to logfile
@@ -164,240 +789,2381 @@ def init_local_vars():
         F = open(logfile,'a')
         F.close()    
     except:
-        servicemanager.LogErrorMsg("Cannot append to file: " + logfile)
+        log_error_msg("Cannot append to file: " + logfile)
         return "", "", 0
     
     return sqlite_dbfile, logfile, 1
 
-""" Loads dict of dicts statetable {{}} from data in sqlite_dbfile """
-def read_state_table_from_db_file(statetable, logfile, sqlite_dbfile):
+""" One statetable entry.  Uses __slots__ instead of a dict per service to
+    keep large statetables small, but supports the same ['key'] access (and
+    get / update / in) the rest of the code uses """
+class service_record(object):
+    __slots__ = ('service_short_name', 'service_description', 'laststate',
+                 'expectedstate', 'forceexpectedstate', 'servicetype',
+                 'ImagePath', 'ObjectName', 'ignore_this_service',
+                 'established', 'established_by', 'inactivated')
+
+    def __init__(self, service_short_name=None, service_description=None, laststate=None,
+                 expectedstate=None, forceexpectedstate=None, servicetype=None,
+                 ImagePath=None, ObjectName=None, ignore_this_service=None,
+                 established=None, established_by=None, inactivated=None):
+        self.service_short_name = service_short_name
+        self.service_description = service_description
+        self.laststate = laststate
+        self.expectedstate = expectedstate
+        self.forceexpectedstate = forceexpectedstate
+        self.servicetype = servicetype
+        self.ImagePath = ImagePath
+        self.ObjectName = ObjectName
+        self.ignore_this_service = ignore_this_service
+        self.established = established
+        self.established_by = established_by
+        self.inactivated = inactivated
+
+    @classmethod
+    def from_dict(cls, svc):
+        record = cls()
+        record.update(svc)
+        return record
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def update(self, values):
+        for key in values:
+            self[key] = values[key]
+
+    def __repr__(self):
+        return 'service_record(' + ', '.join(repr(getattr(self, name)) for name in self.__slots__) + ')'
+
+""" Columns of win32service in service_record field order """
+statetable_sql = "SELECT short_name, description, laststate, expectedstate, forceexpectedstate, servicetype, "
+statetable_sql += "ImagePath, ObjectName, ignore_this_service, established, established_by, inactivated "
+statetable_sql += "FROM win32service"
+
+""" Builds a service_record from a statetable_sql row.  The short name and
+    the low-cardinality columns (states, type, account, flags) are interned
+    so thousands of rows share one copy of each string """
+def service_record_from_row(row):
+    intern = sys.intern
+    return service_record(intern(row[0]), row[1],
+                          row[2] and intern(row[2]), row[3] and intern(row[3]),
+                          row[4] and intern(row[4]), row[5] and intern(row[5]),
+                          row[6], row[7] and intern(row[7]),
+                          row[8] and intern(row[8]), row[9],
+                          row[10] and intern(row[10]), row[11])
+
+""" Loads statetable {} of service_records for host from data in
+    sqlite_dbfile, streaming rows from the cursor.  Duplicate short_names
+    resolve to the newest row """
+def read_state_table_from_db_file(statetable, logfile, sqlite_dbfile, host=''):
     try:
         conn = sqlite3.connect(sqlite_dbfile)
         c = conn.cursor()
-        
-        sql = "SELECT short_name, description, laststate, expectedstate, forceexpectedstate, servicetype, "
-        sql += "ImagePath, ObjectName, ignore_this_service, established, established_by "
-        sql += "FROM win32service"
-        #print(sql)
-        
-        c.execute(sql)
-        rows = c.fetchall()
+        c.execute(statetable_sql + " WHERE host = ? ORDER BY win32service_key DESC", (host,))
         total_rows = 0
-        for row in rows:
-            #print(str(row))
-            statetable[row[0]] = {}
-            statetable[row[0]]['service_short_name'] = row[0]
-            statetable[row[0]]['service_description'] = row[1]
-            statetable[row[0]]['laststate'] = row[2]
-            statetable[row[0]]['expectedstate'] = row[3]
-            statetable[row[0]]['forceexpectedstate'] = row[4]
-            statetable[row[0]]['servicetype'] = row[5]
-            statetable[row[0]]['ImagePath'] = row[6]
-            statetable[row[0]]['ObjectName'] = row[7]
-            statetable[row[0]]['ignore_this_service'] = row[8]
-            statetable[row[0]]['established'] = row[9]
-            statetable[row[0]]['established_by'] = row[10]
-            #print(str(row[4]));
+        for row in c:
+            if (row[0] is None):
+                continue
+            # setdefault keeps the newest row and, for a warming_state_table,
+            # anything the poller already holds
+            record = service_record_from_row(row)
+            statetable.setdefault(record.service_short_name, record)
             total_rows = total_rows + 1
             
         write_to_log(("Loaded " + str(total_rows) + " definitions from " + sqlite_dbfile), "", logfile, sqlite_dbfile)
-        conn.commit()
         conn.close()
         return statetable
     except:
-        servicemanager.LogErrorMsg("Failed to load statetable from db file")
+        log_error_msg("Failed to load statetable from db file")
+
+""" statetable that can be polled against before it has finished loading.
+
+    A loader thread streams win32service into the table.  Until it is done,
+    a lookup for a service that hasn't been loaded yet falls back to an
+    indexed single-row query, so a known service is never mistaken for a
+    new one.  Entries the poller already holds are never overwritten by the
+    loader.  Iterating the table should wait for wait_until_warm() """
+class warming_state_table(dict):
+    def __init__(self, logfile, sqlite_dbfile):
+        dict.__init__(self)
+        self.logfile = logfile
+        self.sqlite_dbfile = sqlite_dbfile
+        self.warm = threading.Event()
+        self.point_conn = None
+        self.point_lookups = 0
+        self.loader = threading.Thread(target=self.load, name="warming_state_table")
+        self.loader.daemon = True
+        self.loader.start()
+
+    def load(self):
+        try:
+            read_state_table_from_db_file(self, self.logfile, self.sqlite_dbfile)
+        finally:
+            self.warm.set()
+
+    def wait_until_warm(self, timeout=None):
+        return self.warm.wait(timeout)
+
+    def point_lookup(self, short_name):
+        if self.warm.is_set():
+            if (self.point_conn is not None):
+                self.point_conn.close()
+                self.point_conn = None
+            return None
+        try:
+            if (self.point_conn is None):
+                self.point_conn = sqlite3.connect(self.sqlite_dbfile)
+            self.point_lookups += 1
+            row = self.point_conn.execute(statetable_sql + " WHERE host = '' AND short_name = ? ORDER BY win32service_key DESC LIMIT 1", (short_name,)).fetchone()
+        except:
+            log_error_msg("Failed to look up " + short_name + " while loading statetable")
+            return None
+        if (row is None):
+            return None
+        record = service_record_from_row(row)
+        return self.setdefault(record.service_short_name, record)
+
+    """ True when there are no services for this machine, answered by one
+        indexed query if the loader hasn't finished yet """
+    def is_empty(self):
+        if (dict.__len__(self) > 0):
+            return False
+        if self.warm.is_set():
+            return True
+        try:
+            conn = sqlite3.connect(self.sqlite_dbfile)
+            try:
+                row = conn.execute("SELECT 1 FROM win32service WHERE host = '' LIMIT 1").fetchone()
+            finally:
+                conn.close()
+        except:
+            log_error_msg("Failed to check for services while loading statetable")
+            return False
+        return (row is None) and (dict.__len__(self) == 0)
+
+    def __contains__(self, short_name):
+        if dict.__contains__(self, short_name):
+            return True
+        return (self.point_lookup(short_name) is not None)
+
+    def __missing__(self, short_name):
+        record = self.point_lookup(short_name)
+        if (record is None):
+            raise KeyError(short_name)
+        return record
 
 """ Checks the state table to see if we need to attempt to start or stop
-    a service that is not in the epectedstate """
-def force_state_if_necessary(statetable, short_name, serviceState, logfile, sqlite_dbfile):
+    a service that is not in the epectedstate
+
+    With an enforcer (enforcement_scheduler) the action is queued instead of
+    run inline; it is skipped while one is already in flight for the
+    service or while the service is backing off after failures """
+def force_state_if_necessary(statetable, short_name, serviceState, logfile, sqlite_dbfile, backend=None, enforcer=None):
+    if (backend is None):
+        backend = pywin32_scm_backend()
     if (statetable[short_name]['forceexpectedstate'] != None):
         if (statetable[short_name]['forceexpectedstate'] == 'yes'): 
            # We really only worry about SERVICE_RUNNING and SERVICE_STOPPED
            if ((serviceState == 'SERVICE_RUNNING') and (statetable[short_name]['expectedstate'] == 'SERVICE_STOPPED')):
-                write_to_log(("Attempting to stop service: " + short_name), short_name, logfile, sqlite_dbfile)
+                if (enforcer is not None):
+                    if enforcer.submit(short_name, 'stop'):
+                        write_to_log(("Attempting to stop service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement', serviceState, 'SERVICE_STOPPED')
+                    return
+                write_to_log(("Attempting to stop service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement', serviceState, 'SERVICE_STOPPED')
                 try:
-                    win32serviceutil.StopService(short_name)
+                    backend.stop_service(short_name)
                 except:
-                    write_to_log(("Failed to stop service: " + short_name), short_name, logfile, sqlite_dbfile)
+                    write_to_log(("Failed to stop service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement_failed')
            if ((serviceState == 'SERVICE_STOPPED') and (statetable[short_name]['expectedstate'] == 'SERVICE_RUNNING')):
-                write_to_log(("Attempting to start service: " + short_name), short_name, logfile, sqlite_dbfile)
+                if (enforcer is not None):
+                    if enforcer.submit(short_name, 'start'):
+                        write_to_log(("Attempting to start service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement', serviceState, 'SERVICE_RUNNING')
+                    return
+                write_to_log(("Attempting to start service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement', serviceState, 'SERVICE_RUNNING')
                 try:
-                    win32serviceutil.StartService(short_name)
+                    backend.start_service(short_name)
                 except:
-                    write_to_log(("Failed to start service: " + short_name), short_name, logfile, sqlite_dbfile)
-                    
-""" Routine to create a new sqlite db file/schema """
-def init_w32services_db(sqlite_dbfile):
+                    write_to_log(("Failed to start service: " + short_name), short_name, logfile, sqlite_dbfile, 'enforcement_failed')
+
+""" Runs forceexpectedstate start/stop actions on a thread pool so a slow
+    service never holds up checking the others.
+
+    submit() is called from the poll thread and refuses an action while
+    one is in flight for the same service or while the service is backing
+    off after failures (enforcement_backoff, doubling up to
+    enforcement_backoff_max).  At most max_workers actions run at once.
+    After the start/stop call an action waits for the service to reach the
+    target state, and gives up after pending_timeout seconds in a pending
+    state.  Finished actions are collected with drain_results() on the poll
+    thread """
+class enforcement_scheduler:
+    pending_states = (2, 3, 5, 6)
+    settle_seconds = 2.0        # grace period before a non-pending state counts as failure
+    check_seconds = 0.5
+
+    def __init__(self, backend, max_workers=enforcement_workers, backoff=enforcement_backoff,
+                 backoff_max=enforcement_backoff_max, pending_timeout=enforcement_pending_timeout):
+        self.backend = backend
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pending_timeout = pending_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.closing = threading.Event()
+        self.results = queue.Queue()
+        self.in_flight = {}     # short_name -> action
+        self.failures = {}      # short_name -> (consecutive failures, retry after)
+        self.submitted = 0
+        self.skipped_in_flight = 0
+        self.skipped_backoff = 0
+        self.outcomes = {'ok': 0, 'failed': 0, 'timeout': 0}
+        self.latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def submit(self, short_name, action):
+        if (short_name in self.in_flight):
+            self.skipped_in_flight += 1
+            return False
+        failure = self.failures.get(short_name)
+        if ((failure is not None) and (time.monotonic() < failure[1])):
+            self.skipped_backoff += 1
+            return False
+        self.in_flight[short_name] = action
+        self.submitted += 1
+        self.executor.submit(self.run_action, short_name, action, time.monotonic())
+        return True
+
+    def run_action(self, short_name, action, queued_at):
+        started = time.monotonic()
+        outcome = 'ok'
+        detail = ''
+        try:
+            if (action == 'start'):
+                self.backend.start_service(short_name)
+                target = 4
+            else:
+                self.backend.stop_service(short_name)
+                target = 1
+            while True:
+                state = self.backend.query_service_state(short_name)
+                elapsed = time.monotonic() - started
+                if (state == target):
+                    break
+                if (state in self.pending_states):
+                    if (elapsed >= self.pending_timeout):
+                        outcome = 'timeout'
+                        detail = 'still ' + str(serviceStates.get(state, state)) + ' after ' + str(int(elapsed)) + 's'
+                        break
+                elif (elapsed >= self.settle_seconds):
+                    outcome = 'failed'
+                    detail = 'service is ' + str(serviceStates.get(state, state))
+                    break
+                if self.closing.wait(self.check_seconds):
+                    outcome = 'timeout'
+                    detail = 'monitor stopping'
+                    break
+        except Exception as e:
+            outcome = 'failed'
+            detail = str(e)
+        self.results.put((short_name, action, outcome, detail, time.monotonic() - started, started - queued_at))
+
+    """ Finished actions since the last call as (short_name, action, outcome,
+        detail, latency, queue wait) tuples; also updates the backoff state """
+    def drain_results(self):
+        results = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            short_name, action, outcome, detail, latency, wait = result
+            self.in_flight.pop(short_name, None)
+            self.outcomes[outcome] += 1
+            self.latency_seconds += latency
+            self.max_latency_seconds = max(self.max_latency_seconds, latency)
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            if (metrics is not None):
+                metrics.observe('enforcement_action', latency)
+                metrics.observe('enforcement_queue_wait', wait)
+                metrics.count('enforcement_' + outcome)
+            if (outcome == 'ok'):
+                self.failures.pop(short_name, None)
+            else:
+                count = self.failures.get(short_name, (0, 0))[0] + 1
+                delay = min(self.backoff * (2 ** (count - 1)), self.backoff_max)
+                self.failures[short_name] = (count, time.monotonic() + delay)
+            results.append(result)
+        return results
+
+    """ Snapshot of the scheduler counters """
+    def stats(self):
+        finished = sum(self.outcomes.values())
+        return {'submitted': self.submitted,
+                'in_flight': len(self.in_flight),
+                'backing_off': len(self.failures),
+                'skipped_in_flight': self.skipped_in_flight,
+                'skipped_backoff': self.skipped_backoff,
+                'ok': self.outcomes['ok'],
+                'failed': self.outcomes['failed'],
+                'timeout': self.outcomes['timeout'],
+                'mean_latency_seconds': (self.latency_seconds / finished) if finished else 0.0,
+                'max_latency_seconds': self.max_latency_seconds,
+                'mean_wait_seconds': (self.wait_seconds / finished) if finished else 0.0,
+                'max_wait_seconds': self.max_wait_seconds}
+
+    def close(self):
+        self.closing.set()
+        self.executor.shutdown(wait=True)
+        self.drain_results()
+
+""" Logs the outcome of finished enforcement actions """
+def report_enforcement_results(enforcer, logfile, sqlite_dbfile):
+    for (short_name, action, outcome, detail, latency, wait) in enforcer.drain_results():
+        verb = 'start' if (action == 'start') else 'stop'
+        if (outcome == 'ok'):
+            logentry = 'Service ' + short_name + ' ' + verb + ' completed in ' + ('%.1f' % latency) + 's'
+        elif (outcome == 'timeout'):
+            logentry = 'Timed out trying to ' + verb + ' service: ' + short_name + ' (' + detail + ')'
+        else:
+            logentry = 'Failed to ' + verb + ' service: ' + short_name + ' (' + detail + '), retrying in ' + str(int(enforcer.failures[short_name][1] - time.monotonic())) + 's'
+        write_to_log(logentry, short_name, logfile, sqlite_dbfile, 'enforcement_' + outcome)
+
+""" Schema migrations, applied in order by migrate_w32services_db().  Each
+    one takes a cursor inside an open transaction; PRAGMA user_version
+    records the last one applied """
+def migration_base_tables(c):
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service' + "' ("
+    sql = sql + "'win32service_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
+    sql = sql + "'short_name' TEXT, "
+    sql = sql + "'description' TEXT, "
+    sql = sql + "'laststate' TEXT, "
+    sql = sql + "'expectedstate' TEXT, "
+    sql = sql + "'forceexpectedstate' TEXT, "
+    sql = sql + "'servicetype' TEXT, "
+    sql = sql + "'servicestarttype' TEXT, "
+    sql = sql + "'serviceerrorcontrol' TEXT, "
+    sql = sql + "'ImagePath' TEXT, "
+    sql = sql + "'ObjectName' TEXT, "
+    sql = sql + "'ignore_this_service' TEXT, "
+    sql = sql + "'notes' TEXT, "
+    sql = sql + "'established' DATETIME, "
+    sql = sql + "'established_by' TEXT, "
+    sql = sql + "'edited' DATETIME, "
+    sql = sql + "'edited_by' TEXT, "
+    sql = sql + "'inactivated' DATETIME, "
+    sql = sql + "'inactivated_by' TEXT"
+    sql = sql + ");"
+    
+    # print(sql)
+    c.execute(sql)
+    
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_log' + "' ("
+    sql = sql + "'win32service_log_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
+    sql = sql + "'win32service_short_name' TEXT, "
+    sql = sql + "'logentry' TEXT, "
+    sql = sql + "'established' DATETIME, "
+    sql = sql + "'established_by' TEXT"
+    sql = sql + ");"
+    
+    # print(sql)
+    c.execute(sql)
+
+def migration_indexes(c):
+    # laststate updates look services up by short_name every poll
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_short_name_idx ON win32service (short_name);")
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_log_short_name_idx ON win32service_log (win32service_short_name);")
+    # retention walks the log by age
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_log_established_idx ON win32service_log (established);")
+
+def migration_log_daily(c):
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_log_daily' + "' ("
+    sql = sql + "'win32service_log_daily_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
+    sql = sql + "'day' DATE, "
+    sql = sql + "'win32service_short_name' TEXT, "
+    sql = sql + "'entries' INTEGER, "
+    sql = sql + "'first_established' DATETIME, "
+    sql = sql + "'last_established' DATETIME"
+    sql = sql + ");"
+    c.execute(sql)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS win32service_log_daily_idx ON win32service_log_daily (day, win32service_short_name);")
+
+def migration_state_summary(c):
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_state_summary' + "' ("
+    sql = sql + "'win32service_state_summary_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
+    sql = sql + "'win32service_short_name' TEXT, "
+    sql = sql + "'out_of_state_count' INTEGER DEFAULT 0, "
+    sql = sql + "'out_of_state_seconds' REAL DEFAULT 0, "
+    sql = sql + "'polls_out_of_state' INTEGER DEFAULT 0, "
+    sql = sql + "'last_out_of_state' DATETIME, "
+    sql = sql + "'last_back_in_state' DATETIME"
+    sql = sql + ");"
+    c.execute(sql)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS win32service_state_summary_idx ON win32service_state_summary (win32service_short_name);")
+
+""" Latest metrics snapshot, one row per series, replaced by the exporter """
+def migration_metrics(c):
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_metrics' + "' ("
+    sql = sql + "'name' TEXT PRIMARY KEY NOT NULL, "
+    sql = sql + "'kind' TEXT, "
+    sql = sql + "'value' REAL, "
+    sql = sql + "'updated' DATETIME"
+    sql = sql + ");"
+    c.execute(sql)
+
+""" Adds host to every per-service table so one db can hold a fleet, ''
+    being the local machine, and re-keys the lookups on (host, short_name) """
+def migration_fleet_hosts(c):
+    for table in ('win32service', 'win32service_log', 'win32service_log_daily', 'win32service_state_summary'):
+        c.execute("ALTER TABLE " + table + " ADD COLUMN host TEXT NOT NULL DEFAULT ''")
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_host_short_name_idx ON win32service (host, short_name);")
+    c.execute("DROP INDEX IF EXISTS win32service_log_daily_idx;")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS win32service_log_daily_idx ON win32service_log_daily (day, host, win32service_short_name);")
+    c.execute("DROP INDEX IF EXISTS win32service_state_summary_idx;")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS win32service_state_summary_idx ON win32service_state_summary (host, win32service_short_name);")
+
+""" Service state history: win32service_history_names maps each host's
+    service names to small integer ids, win32service_history holds one row
+    per poll that saw changes (see snapshot_history) """
+def migration_history(c):
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_history_names' + "' ("
+    sql = sql + "'host' TEXT NOT NULL DEFAULT '', "
+    sql = sql + "'name_id' INTEGER NOT NULL, "
+    sql = sql + "'short_name' TEXT, "
+    sql = sql + "PRIMARY KEY (host, name_id)"
+    sql = sql + ");"
+    c.execute(sql)
+    sql = 'CREATE TABLE IF NOT EXISTS '
+    sql = sql + "'" + 'win32service_history' + "' ("
+    sql = sql + "'win32service_history_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
+    sql = sql + "'host' TEXT NOT NULL DEFAULT '', "
+    sql = sql + "'taken' INTEGER, "
+    sql = sql + "'keyframe' INTEGER, "
+    sql = sql + "'delta' BLOB"
+    sql = sql + ");"
+    c.execute(sql)
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_history_taken_idx ON win32service_history (host, taken);")
+
+""" Newest win32service row per (host, short_name), what the statetable
+    loader sees.  Resolved through win32service_host_short_name_idx """
+def migration_current_view(c):
+    sql = "CREATE VIEW IF NOT EXISTS win32service_current AS SELECT * FROM win32service w "
+    sql += "WHERE w.win32service_key = (SELECT max(k.win32service_key) FROM win32service k "
+    sql += "WHERE k.host = w.host AND k.short_name = w.short_name)"
+    c.execute(sql)
+
+""" Policy edits made in the db: a trigger stamping edited when a db
+    editor changes a policy column without setting it, and a policy_seq
+    numbering every such edit.  edited is local time and can go backwards
+    (DST, clock changes, hand typed values), so policy_reloader uses
+    policy_seq as its high-water mark """
+def migration_policy_edits(c):
+    sql = "CREATE TRIGGER IF NOT EXISTS win32service_policy_edited "
+    sql += "AFTER UPDATE OF expectedstate, forceexpectedstate, ignore_this_service ON win32service "
+    sql += "WHEN NEW.edited IS OLD.edited BEGIN "
+    sql += "UPDATE win32service SET edited = datetime('now','localtime') WHERE win32service_key = NEW.win32service_key; "
+    sql += "END"
+    c.execute(sql)
+    c.execute("ALTER TABLE win32service ADD COLUMN policy_seq INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS win32service_policy_seq_idx ON win32service (policy_seq);")
+    sql = "CREATE TRIGGER IF NOT EXISTS win32service_policy_seq "
+    sql += "AFTER UPDATE OF expectedstate, forceexpectedstate, ignore_this_service ON win32service BEGIN "
+    sql += "UPDATE win32service SET policy_seq = (SELECT coalesce(max(policy_seq), 0) + 1 FROM win32service) WHERE win32service_key = NEW.win32service_key; "
+    sql += "END"
+    c.execute(sql)
+
+schema_migrations = [
+    (1, 'win32service + win32service_log tables', migration_base_tables),
+    (2, 'short_name / established indexes', migration_indexes),
+    (3, 'win32service_log_daily summary table', migration_log_daily),
+    (4, 'win32service_state_summary table', migration_state_summary),
+    (5, 'win32service_metrics table', migration_metrics),
+    (6, 'host column for fleet collection', migration_fleet_hosts),
+    (7, 'win32service_history snapshot tables', migration_history),
+    (8, 'win32service_current view', migration_current_view),
+    (9, 'policy edit triggers + policy_seq column', migration_policy_edits),
+    ]
+
+""" Brings sqlite_dbfile up to the latest schema version.  A brand new file
+    also gets auto_vacuum = INCREMENTAL; older files are only converted at
+    service start with convert_auto_vacuum """
+def migrate_w32services_db(sqlite_dbfile):
+    conn = sqlite3.connect(sqlite_dbfile, isolation_level=None)
     try:
-        conn = sqlite3.connect(sqlite_dbfile)
-        c = conn.cursor()
-        
-        sql = 'CREATE TABLE IF NOT EXISTS '
-        sql = sql + "'" + 'win32service' + "' ("
-        sql = sql + "'win32service_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
-        sql = sql + "'short_name' TEXT, "
-        sql = sql + "'description' TEXT, "
-        sql = sql + "'laststate' TEXT, "
-        sql = sql + "'expectedstate' TEXT, "
-        sql = sql + "'forceexpectedstate' TEXT, "
-        sql = sql + "'servicetype' TEXT, "
-        sql = sql + "'servicestarttype' TEXT, "
-        sql = sql + "'serviceerrorcontrol' TEXT, "
-        sql = sql + "'ImagePath' TEXT, "
-        sql = sql + "'ObjectName' TEXT, "
-        sql = sql + "'ignore_this_service' TEXT, "
-        sql = sql + "'notes' TEXT, "
-        sql = sql + "'established' DATETIME, "
-        sql = sql + "'established_by' TEXT, "
-        sql = sql + "'edited' DATETIME, "
-        sql = sql + "'edited_by' TEXT, "
-        sql = sql + "'inactivated' DATETIME, "
-        sql = sql + "'inactivated_by' TEXT"
-        sql = sql + ");"
-        
-        # print(sql)
-        c.execute(sql)
-        
-        sql = 'CREATE TABLE IF NOT EXISTS '
-        sql = sql + "'" + 'win32service_log' + "' ("
-        sql = sql + "'win32service_log_key' INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL UNIQUE, "
-        sql = sql + "'win32service_short_name' TEXT, "
-        sql = sql + "'logentry' TEXT, "
-        sql = sql + "'established' DATETIME, "
-        sql = sql + "'established_by' TEXT"
-        sql = sql + ");"
-        
-        # print(sql)
-        c.execute(sql)
-        
-        conn.commit()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if (version == 0) and (conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0):
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        for (target, description, migration) in schema_migrations:
+            if (target <= version):
+                continue
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                migration(c)
+                c.execute("PRAGMA user_version = " + str(target))
+                c.execute("COMMIT")
+            except:
+                c.execute("ROLLBACK")
+                log_error_msg("Schema migration " + str(target) + " (" + description + ") failed: " + sqlite_dbfile)
+                raise
+            version = target
+        return version
+    finally:
         conn.close()
+
+""" Routine to create a new sqlite db file/schema (or upgrade an old one) """
+def init_w32services_db(sqlite_dbfile):
+    try:
+        migrate_w32services_db(sqlite_dbfile)
     except:
-        servicemanager.LogErrorMsg("Error creating: " + sqlite_dbfile)
+        log_error_msg("Error creating: " + sqlite_dbfile)
+
+""" Moves one batch (at most log_retention_batch rows) of win32service_log
+    rows older than cutoff into win32service_log_daily, or just deletes them
+    with log_retention_policy = 'delete'.  Returns the number of rows
+    pruned, 0 once nothing older than cutoff is left """
+def prune_log_batch(conn, cutoff, batch_size=log_retention_batch, policy=log_retention_policy):
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # bound the batch by key so the summary and delete see the same rows
+        row = c.execute("SELECT win32service_log_key FROM win32service_log WHERE established < ? "
+                        "ORDER BY win32service_log_key LIMIT 1 OFFSET ?", (cutoff, batch_size - 1)).fetchone()
+        if (row is None):
+            row = c.execute("SELECT max(win32service_log_key) FROM win32service_log WHERE established < ?", (cutoff,)).fetchone()
+        max_key = row[0]
+        if (max_key is None):
+            c.execute("COMMIT")
+            return 0
+        if (policy == 'summarize'):
+            sql = "SELECT date(established), host, win32service_short_name, count(*), min(established), max(established) "
+            sql += "FROM win32service_log WHERE established < ? AND win32service_log_key <= ? "
+            sql += "GROUP BY date(established), host, win32service_short_name"
+            for (day, host, short_name, entries, first, last) in c.execute(sql, (cutoff, max_key)).fetchall():
+                c.execute("UPDATE win32service_log_daily SET entries = entries + ?, "
+                          "first_established = min(first_established, ?), last_established = max(last_established, ?) "
+                          "WHERE day = ? AND host = ? AND win32service_short_name IS ?", (entries, first, last, day, host, short_name))
+                if (c.rowcount == 0):
+                    c.execute("INSERT INTO win32service_log_daily (day, host, win32service_short_name, entries, "
+                              "first_established, last_established) VALUES (?, ?, ?, ?, ?, ?)",
+                              (day, host, short_name, entries, first, last))
+        c.execute("DELETE FROM win32service_log WHERE established < ? AND win32service_log_key <= ?", (cutoff, max_key))
+        pruned = c.rowcount
+        c.execute("COMMIT")
+        return pruned
+    except:
+        c.execute("ROLLBACK")
+        raise
+
+""" Drops win32service_history rows older than cutoff (epoch seconds),
+    keeping each host's last keyframe before cutoff so the remaining
+    history can still be reconstructed """
+def prune_history(conn, cutoff):
+    sql = "DELETE FROM win32service_history WHERE taken < "
+    sql += "(SELECT max(k.taken) FROM win32service_history k "
+    sql += "WHERE k.host = win32service_history.host AND k.keyframe = 1 AND k.taken <= ?)"
+    conn.execute(sql, (cutoff,))
+
+""" Converts a db created before auto_vacuum = INCREMENTAL with one full
+    VACUUM, which rewrites the whole file and holds the write lock until it
+    is done.  Only run from SvcDoRun before the log writer opens.  Returns
+    the seconds it took, None when the db was already converted """
+def convert_to_incremental_vacuum(sqlite_dbfile):
+    conn = sqlite3.connect(sqlite_dbfile, timeout=30, isolation_level=None)
+    try:
+        if (conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2):
+            return None
+        started = time.perf_counter()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+""" Background db upkeep, kept off the polling path: every
+    maintenance_interval seconds prunes win32service_log past
+    log_retention_days in bounded batches, then returns free pages to the
+    filesystem with an incremental vacuum.  A db created before
+    auto_vacuum = INCREMENTAL only gets its free pages back once it has been
+    converted at start-up (convert_auto_vacuum) """
+class db_maintenance_thread:
+    def __init__(self, sqlite_dbfile, logfile, interval=maintenance_interval):
+        self.sqlite_dbfile = sqlite_dbfile
+        self.logfile = logfile
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="db_maintenance_thread")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.maintain()
+            except:
+                log_error_msg("db maintenance failed: " + self.sqlite_dbfile)
+
+    def maintain(self):
+        conn = sqlite3.connect(self.sqlite_dbfile, timeout=30, isolation_level=None)
+        try:
+            pruned = 0
+            if (log_retention_days > 0):
+                cutoff = (datetime.datetime.now() - datetime.timedelta(days=log_retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+                while not self.stopping.is_set():
+                    batch = prune_log_batch(conn, cutoff)
+                    pruned += batch
+                    if (batch < log_retention_batch):
+                        break
+                    # let the log writer in between batches
+                    self.stopping.wait(0.1)
+            if pruned:
+                write_to_log(("Pruned " + str(pruned) + " log entries older than " + cutoff), "", self.logfile, self.sqlite_dbfile)
+            if (history_retention_days > 0):
+                prune_history(conn, int(time.time()) - (history_retention_days * 86400))
+            if self.stopping.is_set():
+                return
+            conn.execute("PRAGMA incremental_vacuum(" + str(int(incremental_vacuum_pages)) + ")").fetchall()
+        finally:
+            conn.close()
+
+    def stop(self, timeout=30):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+""" Counters and timers for the monitor's hot paths.
+
+    count(name, n) bumps a counter; observe(name, seconds) adds to a timer
+    (count / total / max) and, for names in histogram_buckets, to a
+    cumulative histogram.  Safe to call from the writer and enforcement
+    threads.  snapshot() returns flat (name, kind, value) series named the
+    prometheus way so they can go to either exporter """
+class monitor_metrics:
+    histogram_buckets = {'poll_cycle': (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}        # name -> [count, total seconds, max seconds]
+        self.histograms = {}    # name -> per bucket counts, last one is +Inf
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if (timer is None):
+                timer = self.timers[name] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            if (seconds > timer[2]):
+                timer[2] = seconds
+            buckets = self.histogram_buckets.get(name)
+            if (buckets is not None):
+                counts = self.histograms.get(name)
+                if (counts is None):
+                    counts = self.histograms[name] = [0] * (len(buckets) + 1)
+                for i, bound in enumerate(buckets):
+                    if (seconds <= bound):
+                        counts[i] += 1
+                        break
+                else:
+                    counts[-1] += 1
+
+    def snapshot(self):
+        series = []
+        with self.lock:
+            for name in sorted(self.counters):
+                series.append(('wsm_' + name + '_total', 'counter', self.counters[name]))
+            for name in sorted(self.timers):
+                count, total, longest = self.timers[name]
+                kind = 'histogram' if (name in self.histograms) else 'summary'
+                if (kind == 'histogram'):
+                    cumulative = 0
+                    bounds = [str(bound) for bound in self.histogram_buckets[name]] + ['+Inf']
+                    for bound, bucket_count in zip(bounds, self.histograms[name]):
+                        cumulative += bucket_count
+                        series.append(('wsm_' + name + '_seconds_bucket{le="' + bound + '"}', kind, cumulative))
+                series.append(('wsm_' + name + '_seconds_count', kind, count))
+                series.append(('wsm_' + name + '_seconds_sum', kind, total))
+                series.append(('wsm_' + name + '_seconds_max', 'gauge', longest))
+        return series
+
+    """ Snapshot in the prometheus text exposition format """
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+        for name, kind, value in self.snapshot():
+            family = name.split('{')[0]
+            if (kind in ('summary', 'histogram')):
+                family = family.rsplit('_', 1)[0]
+            if (family not in typed):
+                typed.add(family)
+                lines.append('# TYPE ' + family + ' ' + kind)
+            lines.append(name + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+""" Writes a monitor_metrics snapshot every interval seconds to the
+    win32service_metrics table and/or a prometheus text file (written to a
+    temp file then renamed, so a scraper never sees half a file), per
+    metrics_export """
+class metrics_exporter:
+    def __init__(self, registry, sqlite_dbfile, interval=metrics_interval, export=metrics_export, prometheus_file=metrics_file):
+        self.registry = registry
+        self.sqlite_dbfile = sqlite_dbfile
+        self.interval = interval
+        self.export = export
+        self.prometheus_file = prometheus_file or (os.path.splitext(sqlite_dbfile)[0] + '.prom')
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics_exporter")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if (self.export in ('table', 'both')):
+            try:
+                self.write_table()
+            except:
+                log_error_msg("Error, cannot write metrics to db: " + self.sqlite_dbfile)
+        if (self.export in ('prometheus', 'both')):
+            try:
+                self.write_prometheus()
+            except:
+                log_error_msg("Error, cannot write metrics file: " + self.prometheus_file)
+
+    def write_table(self):
+        updated = db_timestamp()
+        rows = [(name, kind, value, updated) for (name, kind, value) in self.registry.snapshot()]
+        conn = sqlite3.connect(self.sqlite_dbfile, timeout=30)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO win32service_metrics (name, kind, value, updated) VALUES (?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+
+    def write_prometheus(self):
+        tmpfile = self.prometheus_file + '.tmp'
+        F = open(tmpfile, 'w')
+        F.write(self.registry.prometheus_text())
+        F.close()
+        os.replace(tmpfile, self.prometheus_file)
+
+    def stop(self, timeout=30):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self.write()
+
+""" SCM backends
+
+    check_services() and force_state_if_necessary() only talk to the Service
+    Control Manager through a backend object providing:
+
+        enum_services()                 -> [(short_name, desc, status), ...]
+                                           shaped like EnumServicesStatus
+        query_service_config(short_name) -> {'ImagePath': .., 'ObjectName': ..}
+        start_service(short_name)
+        stop_service(short_name)
+        query_service_state(short_name) -> current state (SERVICE_RUNNING etc)
+
+    query_service_config() is built on the lower level registry calls
+
+        open_service_key(short_name)    -> key handle, raises if missing
+        service_key_last_write(hkey)    -> key last-write time (or None)
+        read_service_key(hkey)          -> {'ImagePath': .., 'ObjectName': ..}
+        close_service_key(hkey)
+
+    which service_metadata_cache uses to memoize lookups
+    """
+
+""" Registry values read for every service, '' when missing """
+service_key_values = ('ImagePath', 'ObjectName')
+
+""" Expands every %VAR% in path from the environment, leaving unknown
+    variables as they are """
+env_var_pattern = re.compile(r'%([^%]+)%')
+
+def expand_env_vars(path):
+    return env_var_pattern.sub(lambda m: os.environ.get(m.group(1), m.group(0)), path)
+
+""" Backend for a live SCM via pywin32 (machine=None is the local machine).
+    Registry reads for a remote machine go through its remote registry """
+class pywin32_scm_backend:
+    def __init__(self, machine=None):
+        self.machine = machine
+
+    def enum_services(self):
+        accessSCM = win32con.GENERIC_READ
+        #Open Service Control Manager
+        hscm = win32service.OpenSCManager(self.machine, None, accessSCM)
+        try:
+            #Enumerate Service Control Manager DB
+            typeFilter = win32service.SERVICE_WIN32
+            stateFilter = win32service.SERVICE_STATE_ALL
+            return win32service.EnumServicesStatus(hscm, typeFilter, stateFilter)
+        finally:
+            win32service.CloseServiceHandle(hscm)
+
+    # Some facets of services only seem to be available via the registry
+    # we try and get the executable + run-with-credentials here
+    def query_service_config(self, short_name):
+        try:
+            hkey = self.open_service_key(short_name)
+        except:
+            return dict.fromkeys(service_key_values, '')
+        try:
+            return self.read_service_key(hkey)
+        finally:
+            self.close_service_key(hkey)
+
+    def open_service_key(self, short_name):
+        access = win32con.KEY_READ | win32con.KEY_ENUMERATE_SUB_KEYS | win32con.KEY_QUERY_VALUE
+        hkey_base = "SYSTEM\\CurrentControlSet\\Services"
+        hkey_key = "\\" + short_name
+        if (self.machine is None):
+            return win32api.RegOpenKey(win32con.HKEY_LOCAL_MACHINE, (hkey_base + hkey_key), 0, access)
+        # the service key stays open after the remote hive handle is closed
+        hive = win32api.RegConnectRegistry(self.machine, win32con.HKEY_LOCAL_MACHINE)
+        try:
+            return win32api.RegOpenKey(hive, (hkey_base + hkey_key), 0, access)
+        finally:
+            win32api.RegCloseKey(hive)
+
+    def service_key_last_write(self, hkey):
+        try:
+            return win32api.RegQueryInfoKeyW(hkey)['LastWriteTime']
+        except:
+            # older pywin32 builds, lookups just won't be cached
+            return None
+
+    def read_service_key(self, hkey):
+        config = {}
+        for value_name in service_key_values:
+            try:
+                config[value_name] = str(win32api.RegQueryValueEx(hkey, value_name)[0])
+            except:
+                config[value_name] = ''
+        return config
+
+    def close_service_key(self, hkey):
+        win32api.RegCloseKey(hkey)
+
+    def start_service(self, short_name):
+        win32serviceutil.StartService(short_name, machine=self.machine)
+
+    def stop_service(self, short_name):
+        win32serviceutil.StopService(short_name, machine=self.machine)
+
+    def query_service_state(self, short_name):
+        return win32serviceutil.QueryServiceStatus(short_name, machine=self.machine)[1]
+
+""" In-process fake SCM holding service_count synthetic services.  Each
+    enum_services() call first applies churn: churn_rate is the fraction of
+    services flipping between running/stopped, add_rate / remove_rate the
+    fraction of services installed / uninstalled.  seed makes runs
+    reproducible for benchmarking.
+
+    Start/stop behaviour can be scripted per service: control_delays makes
+    the start/stop call itself block for that many seconds, failing
+    services raise from it, and stuck services stay in START/STOP_PENDING """
+class synthetic_scm_backend:
+    def __init__(self, service_count=300, churn_rate=0.0, add_rate=0.0, remove_rate=0.0, seed=None):
+        self.random = random.Random(seed)
+        self.churn_rate = churn_rate
+        self.add_rate = add_rate
+        self.remove_rate = remove_rate
+        self.services = {}      # short_name -> [desc, servicetype, state]
+        self.key_writes = {}    # short_name -> registry key last-write counter
+        self.accounts = {}      # short_name -> ObjectName, for services moved off LocalSystem
+        self.registry_reads = 0
+        self.control_delays = {}
+        self.failing = set()
+        self.stuck = set()
+        self.control_calls = 0
+        self.next_id = 0
+        self.enum_count = 0
+        for i in range(service_count):
+            self.add_service()
+
+    def add_service(self):
+        short_name = 'SynthSvc%06d' % self.next_id
+        self.next_id += 1
+        servicetype = self.random.choice((0x10, 0x20))
+        state = self.random.choice((1, 4))
+        self.services[short_name] = ['Synthetic service ' + short_name, servicetype, state]
+        self.key_writes[short_name] = self.key_writes.get(short_name, 0) + 1
+        return short_name
+
+    """ Number of services to touch for a given rate, carrying the fraction
+        over randomly so small rates still produce changes """
+    def rate_count(self, rate):
+        return int((rate * len(self.services)) + self.random.random())
+
+    def churn(self):
+        if self.churn_rate:
+            names = list(self.services)
+            for short_name in self.random.sample(names, min(self.rate_count(self.churn_rate), len(names))):
+                svc = self.services[short_name]
+                svc[2] = 1 if (svc[2] == 4) else 4
+        if self.remove_rate:
+            names = list(self.services)
+            for short_name in self.random.sample(names, min(self.rate_count(self.remove_rate), len(names))):
+                del self.services[short_name]
+        if self.add_rate:
+            for i in range(self.rate_count(self.add_rate)):
+                self.add_service()
+
+    def enum_services(self):
+        self.enum_count += 1
+        self.churn()
+        return [(short_name, svc[0], (svc[1], svc[2], 0, 0, 0, 0, 0))
+                for short_name, svc in self.services.items()]
+
+    def query_service_config(self, short_name):
+        if (short_name not in self.services):
+            return dict.fromkeys(service_key_values, '')
+        return self.read_service_key(short_name)
+
+    def open_service_key(self, short_name):
+        if (short_name not in self.services):
+            raise KeyError(short_name)
+        return short_name
+
+    def service_key_last_write(self, hkey):
+        return self.key_writes[hkey]
+
+    def read_service_key(self, hkey):
+        self.registry_reads += 1
+        return {'ImagePath': '%SystemRoot%\\System32\\' + hkey + '.exe',
+                'ObjectName': self.accounts.get(hkey, 'LocalSystem')}
+
+    def close_service_key(self, hkey):
+        pass
+
+    def control(self, short_name, pending, target):
+        self.control_calls += 1
+        if (short_name in self.control_delays):
+            time.sleep(self.control_delays[short_name])
+        if (short_name in self.failing):
+            raise RuntimeError('synthetic failure controlling ' + short_name)
+        self.services[short_name][2] = pending if (short_name in self.stuck) else target
+
+    def start_service(self, short_name):
+        self.control(short_name, 2, 4)
+
+    def stop_service(self, short_name):
+        self.control(short_name, 3, 1)
+
+    def query_service_state(self, short_name):
+        return self.services[short_name][2]
+
+""" Layer over an SCM backend that memoizes query_service_config() per
+    service, keyed by short_name plus the registry key's last-write time.
+    Each lookup opens the key once and always closes it; the values are only
+    re-read when the key has been written since.  Everything else is passed
+    through to the wrapped backend.
+
+    Besides new services, monitor_cycle() looks up every known service
+    through it each refresh_interval seconds (refresh_service_metadata), so
+    a changed executable or service account is noticed at the cost of an
+    open / last-write check per unchanged key """
+class service_metadata_cache:
+    def __init__(self, backend, refresh_interval=metadata_refresh_interval):
+        self.backend = backend
+        self.refresh_interval = refresh_interval
+        self.next_refresh = time.monotonic()
+        self.entries = {}       # short_name -> (last_write, config)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lookup_seconds = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def query_service_config(self, short_name):
+        start = time.perf_counter()
+        config = self.lookup(short_name)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.lookup_seconds += elapsed
+        return dict(config)
+
+    def lookup(self, short_name):
+        try:
+            hkey = self.backend.open_service_key(short_name)
+        except:
+            with self.lock:
+                self.errors += 1
+            return dict.fromkeys(service_key_values, '')
+        try:
+            last_write = self.backend.service_key_last_write(hkey)
+            cached = self.entries.get(short_name)
+            if ((cached is not None) and (last_write is not None) and (cached[0] == last_write)):
+                with self.lock:
+                    self.hits += 1
+                return cached[1]
+            config = self.backend.read_service_key(hkey)
+        finally:
+            self.backend.close_service_key(hkey)
+        with self.lock:
+            self.misses += 1
+            if (last_write is not None):
+                self.entries[short_name] = (last_write, config)
+        return config
+
+    def forget(self, short_name):
+        self.entries.pop(short_name, None)
+
+    """ True (once) when the known services are due for a refresh """
+    def refresh_due(self):
+        now = time.monotonic()
+        if ((self.refresh_interval <= 0) or (now < self.next_refresh)):
+            return False
+        self.next_refresh = now + self.refresh_interval
+        return True
+
+    """ Snapshot of the cache counters """
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.errors
+            return {'entries': len(self.entries),
+                    'lookups': lookups,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'errors': self.errors,
+                    'hit_rate': (float(self.hits) / lookups) if lookups else 0.0,
+                    'lookup_seconds': self.lookup_seconds}
+
+""" Service change notification sources
+
+    In monitor_mode 'notify' run_monitor() waits on a notification source
+    instead of polling.  A source provides:
+
+        wait(timeout)   -> [(event, short_name), ...] with event one of
+                           'created', 'deleted' or 'state'; [] on timeout.
+                           run_monitor() only checks whether it is empty
+        interrupt()     wakes a pending wait() early, e.g. on SvcStop
+        close()
+    """
+
+""" Notification source for an in-process event script, e.g. to drive
+    run_monitor() alongside a synthetic_scm_backend when testing """
+class scripted_notification_source:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def push(self, event, short_name):
+        self.events.put((event, short_name))
+
+    def interrupt(self):
+        self.events.put(None)
+
+    def wait(self, timeout):
+        try:
+            first = self.events.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return []
+        events = [first]
+        # hand back everything queued so far in one batch
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return [event for event in events if event is not None]
+
+    def close(self):
+        pass
+
+""" ctypes bindings for NotifyServiceStatusChangeW, which pywin32 doesn't
+    wrap.  Built on first use so the module still imports off Windows """
+notify_api = None
+
+def load_notify_api():
+    global notify_api
+    if (notify_api is not None):
+        return notify_api
+    from ctypes import wintypes
+
+    class SERVICE_STATUS_PROCESS(ctypes.Structure):
+        _fields_ = [('dwServiceType', wintypes.DWORD),
+                    ('dwCurrentState', wintypes.DWORD),
+                    ('dwControlsAccepted', wintypes.DWORD),
+                    ('dwWin32ExitCode', wintypes.DWORD),
+                    ('dwServiceSpecificExitCode', wintypes.DWORD),
+                    ('dwCheckPoint', wintypes.DWORD),
+                    ('dwWaitHint', wintypes.DWORD),
+                    ('dwProcessId', wintypes.DWORD),
+                    ('dwServiceFlags', wintypes.DWORD)]
+
+    PFN_SC_NOTIFY_CALLBACK = ctypes.WINFUNCTYPE(None, ctypes.c_void_p)
+
+    class SERVICE_NOTIFYW(ctypes.Structure):
+        _fields_ = [('dwVersion', wintypes.DWORD),
+                    ('pfnNotifyCallback', PFN_SC_NOTIFY_CALLBACK),
+                    ('pContext', ctypes.c_void_p),
+                    ('dwNotificationStatus', wintypes.DWORD),
+                    ('ServiceStatus', SERVICE_STATUS_PROCESS),
+                    ('dwNotificationTriggered', wintypes.DWORD),
+                    ('pszServiceNames', ctypes.c_void_p)]
+
+    advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    advapi32.OpenSCManagerW.restype = wintypes.HANDLE
+    advapi32.OpenSCManagerW.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD]
+    advapi32.OpenServiceW.restype = wintypes.HANDLE
+    advapi32.OpenServiceW.argtypes = [wintypes.HANDLE, wintypes.LPCWSTR, wintypes.DWORD]
+    advapi32.CloseServiceHandle.argtypes = [wintypes.HANDLE]
+    advapi32.NotifyServiceStatusChangeW.restype = wintypes.DWORD
+    advapi32.NotifyServiceStatusChangeW.argtypes = [wintypes.HANDLE, wintypes.DWORD, ctypes.POINTER(SERVICE_NOTIFYW)]
+    kernel32.CreateEventW.restype = wintypes.HANDLE
+    kernel32.CreateEventW.argtypes = [ctypes.c_void_p, wintypes.BOOL, wintypes.BOOL, wintypes.LPCWSTR]
+    kernel32.SetEvent.argtypes = [wintypes.HANDLE]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    kernel32.WaitForSingleObjectEx.restype = wintypes.DWORD
+    kernel32.WaitForSingleObjectEx.argtypes = [wintypes.HANDLE, wintypes.DWORD, wintypes.BOOL]
+    kernel32.LocalFree.argtypes = [ctypes.c_void_p]
+
+    notify_api = {'SERVICE_NOTIFYW': SERVICE_NOTIFYW,
+                  'PFN_SC_NOTIFY_CALLBACK': PFN_SC_NOTIFY_CALLBACK,
+                  'advapi32': advapi32,
+                  'kernel32': kernel32}
+    return notify_api
+
+""" Notification source backed by the SCM's NotifyServiceStatusChange.
+
+    The SCM delivers notifications as APCs to the thread that registered
+    them, so a dedicated thread registers for create/delete on the SCM and
+    for state changes on every service, then sits in an alertable wait.
+    Each callback queues an event and asks for its registration to be
+    re-armed once the wait returns (registering from inside the callback
+    is not allowed) """
+class scm_notification_source(scripted_notification_source):
+    SERVICE_NOTIFY_STATUS_CHANGE = 2
+    SC_MANAGER_ENUMERATE_SERVICE = 0x0004
+    SERVICE_QUERY_STATUS = 0x0004
+    SERVICE_NOTIFY_STATES = 0x7f        # STOPPED .. PAUSED
+    SERVICE_NOTIFY_CREATED = 0x80
+    SERVICE_NOTIFY_DELETED = 0x100
+    WAIT_IO_COMPLETION = 0xc0
+    INFINITE = 0xffffffff
+
+    def __init__(self, backend, machine=None):
+        scripted_notification_source.__init__(self)
+        self.api = load_notify_api()
+        self.backend = backend
+        self.machine = machine
+        self.registrations = {}     # context id -> [short_name, handle, SERVICE_NOTIFYW]
+        self.next_context = 1
+        self.rearm = []
+        self.closing = False
+        self.callback = self.api['PFN_SC_NOTIFY_CALLBACK'](self.on_notify)
+        self.hwake = self.api['kernel32'].CreateEventW(None, False, False, None)
+        self.error = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="scm_notification_source")
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+        if (self.error is not None):
+            raise self.error
+
+    def register(self, short_name, handle, mask):
+        notify = self.api['SERVICE_NOTIFYW']()
+        notify.dwVersion = self.SERVICE_NOTIFY_STATUS_CHANGE
+        notify.pfnNotifyCallback = self.callback
+        context = self.next_context
+        self.next_context += 1
+        notify.pContext = context
+        self.registrations[context] = [short_name, handle, notify, mask]
+        self.arm(context)
+
+    def arm(self, context):
+        short_name, handle, notify, mask = self.registrations[context]
+        rc = self.api['advapi32'].NotifyServiceStatusChangeW(handle, mask, ctypes.byref(notify))
+        if (rc != 0):
+            # typically ERROR_SERVICE_MARKED_FOR_DELETE, the deleted event
+            # arrives through the SCM registration
+            self.unregister(context)
+
+    def unregister(self, context):
+        short_name, handle, notify, mask = self.registrations.pop(context)
+        if (short_name is not None):
+            self.api['advapi32'].CloseServiceHandle(handle)
+
+    def watch_service(self, short_name):
+        handle = self.api['advapi32'].OpenServiceW(self.hscm, short_name, self.SERVICE_QUERY_STATUS)
+        if handle:
+            self.register(short_name, handle, self.SERVICE_NOTIFY_STATES)
+
+    def on_notify(self, parameter):
+        notify = ctypes.cast(parameter, ctypes.POINTER(self.api['SERVICE_NOTIFYW'])).contents
+        context = notify.pContext
+        if (context not in self.registrations):
+            return
+        short_name = self.registrations[context][0]
+        if (short_name is None):
+            # SCM registration, pszServiceNames is a multi-string of
+            # service names, created ones prefixed with '/'
+            offset = 0
+            while notify.pszServiceNames:
+                name = ctypes.wstring_at(notify.pszServiceNames + offset)
+                if not name:
+                    break
+                offset += (len(name) + 1) * ctypes.sizeof(ctypes.c_wchar)
+                if name.startswith('/'):
+                    self.push('created', name[1:])
+                    self.rearm.append(('watch', name[1:]))
+                else:
+                    self.push('deleted', name)
+            if notify.pszServiceNames:
+                self.api['kernel32'].LocalFree(notify.pszServiceNames)
+        else:
+            self.push('state', short_name)
+        self.rearm.append(('arm', context))
+
+    def run(self):
+        try:
+            self.hscm = self.api['advapi32'].OpenSCManagerW(self.machine, None, self.SC_MANAGER_ENUMERATE_SERVICE)
+            if not self.hscm:
+                raise ctypes.WinError(ctypes.get_last_error())
+            self.register(None, self.hscm, self.SERVICE_NOTIFY_CREATED | self.SERVICE_NOTIFY_DELETED)
+            for (short_name, desc, status) in self.backend.enum_services():
+                self.watch_service(short_name)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        while not self.closing:
+            self.api['kernel32'].WaitForSingleObjectEx(self.hwake, self.INFINITE, True)
+            rearm, self.rearm = self.rearm, []
+            for action, target in rearm:
+                if (action == 'watch'):
+                    self.watch_service(target)
+                elif (target in self.registrations):
+                    self.arm(target)
+        for context in list(self.registrations):
+            self.unregister(context)
+        self.api['advapi32'].CloseServiceHandle(self.hscm)
+
+    def close(self):
+        self.closing = True
+        self.api['kernel32'].SetEvent(self.hwake)
+        self.thread.join(10)
+        self.api['kernel32'].CloseHandle(self.hwake)
+
+""" Tracks the services seen on the previous poll as interned short_name ->
+    packed (servicetype << 16 | state) int, so each poll is diffed in one pass
+    over the enumeration and only services that were added, removed or changed
+    need any further work.  out_of_state maps the monitored services that
+    are currently not in their expectedstate to an out_of_state_record.
+    statetable_checked is set once the statetable has been compared with an
+    enumeration, which finds services removed while the monitor was down """
+class service_change_detector:
+    def __init__(self):
+        self.snapshot = {}
+        self.pending = {}       # deferred short_name -> packed state last reported in deferred
+        self.deferred = []
+        self.out_of_state = {}
+        self.statetable_checked = False
+        self.last_changes = 0
+
+    """ defer(short_name) can hold back changes to known services: they are
+        left out of the result and stay pending in the snapshot until a
+        diff() that doesn't defer them.  Every change to a deferred service,
+        including one reverting to the snapshot state, is still listed in
+        deferred after the diff, e.g. for the history """
+    def diff(self, statuses, defer=None):
+        snapshot = self.snapshot
+        pending = self.pending
+        added = []
+        changed = []
+        deferred = self.deferred = []
+        seen = 0
+        for entry in statuses:
+            status = entry[2]
+            packed = (status[0] << 16) | status[1]
+            old = snapshot.get(entry[0])
+            if (old is None):
+                added.append(entry)
+            else:
+                seen += 1
+                if (old != packed):
+                    if ((defer is not None) and defer(entry[0])):
+                        if (pending.get(entry[0]) != packed):
+                            pending[entry[0]] = packed
+                            deferred.append(entry)
+                        continue
+                    snapshot[entry[0]] = packed
+                    changed.append(entry)
+                    if pending:
+                        pending.pop(entry[0], None)
+                elif (pending and (entry[0] in pending)):
+                    # changed and back again before it was checked
+                    del pending[entry[0]]
+                    deferred.append(entry)
+        # only build a name set when some previously seen service is missing
+        removed = []
+        if (seen != len(snapshot)):
+            current = set(entry[0] for entry in statuses)
+            removed = [short_name for short_name in snapshot if short_name not in current]
+            for short_name in removed:
+                del snapshot[short_name]
+                pending.pop(short_name, None)
+        for entry in added:
+            snapshot[sys.intern(entry[0])] = (entry[2][0] << 16) | entry[2][1]
+        self.last_changes = len(added) + len(changed) + len(removed)
+        return added, changed, removed
+
+    """ Current state of a service from the snapshot, translated like
+        serviceStates """
+    def state_of(self, short_name):
+        state = self.snapshot[short_name] & 0xffff
+        return serviceStates.get(state, state)
+
+    """ Drops a service from the snapshot so the next diff() reports it as
+        added and it is re-evaluated against the statetable """
+    def invalidate(self, short_name):
+        self.snapshot.pop(short_name, None)
+        self.pending.pop(short_name, None)
+
+""" How long a service has been out of its expectedstate, and what has been
+    reported / written to win32service_state_summary for it so far """
+class out_of_state_record(object):
+    __slots__ = ('since', 'state', 'expectedstate', 'last_report', 'accounted', 'polls')
+
+    def __init__(self, now, state, expectedstate):
+        self.since = now
+        self.state = state
+        self.expectedstate = expectedstate
+        self.last_report = now
+        self.accounted = now
+        self.polls = 0
+
+    """ Summary delta row covering the time / polls since the last one """
+    def summary_row(self, short_name, now, entered=0, last_out_of_state=None, last_back_in_state=None):
+        row = (short_name, entered, now - self.accounted, self.polls, last_out_of_state, last_back_in_state)
+        self.accounted = now
+        self.polls = 0
+        return row
+
+""" Minutes as text for log entries """
+def minutes_text(seconds):
+    return str(int(seconds // 60)) + ' minutes'
+
+""" Varint encoding for win32service_history deltas: (id gap, value) pairs
+    with ids ascending, 7 bits per byte.  value is the SCM state + 1, 0
+    meaning the service was removed """
+def encode_state_delta(items):
+    out = bytearray()
+    previous = 0
+    for name_id, value in items:
+        for number in (name_id - previous, value):
+            while (number >= 0x80):
+                out.append((number & 0x7f) | 0x80)
+                number >>= 7
+            out.append(number)
+        previous = name_id
+    return bytes(out)
+
+def decode_state_delta(blob):
+    numbers = []
+    number = 0
+    shift = 0
+    for byte in blob:
+        number |= (byte & 0x7f) << shift
+        if (byte & 0x80):
+            shift += 7
+        else:
+            numbers.append(number)
+            number = 0
+            shift = 0
+    name_id = 0
+    items = []
+    for i in range(0, len(numbers), 2):
+        name_id += numbers[i]
+        items.append((name_id, numbers[i + 1]))
+    return items
+
+""" Records the service states of one host into win32service_history.
+
+    record() is fed each poll's changes from the change detector,
+    including the ones it deferred for services on the ignore list, and
+    writes one row per poll that saw any: the changed services' name ids
+    and packed states, delta-encoded against the previous poll.  A keyframe
+    holding every service is written on the first poll after start-up and
+    then every keyframe_interval seconds, so a point in time can be rebuilt
+    from at most one keyframe plus an interval's deltas.  Rows go through the
+    log writer like everything else.  Only states are kept, not types """
+class snapshot_history:
+    def __init__(self, sqlite_dbfile, host='', keyframe_interval=history_keyframe_interval):
+        self.sqlite_dbfile = sqlite_dbfile
+        self.host = host
+        self.keyframe_interval = keyframe_interval
+        self.ids = {}
+        self.current = {}       # name_id -> state + 1
+        self.last_keyframe = None
+        self.rows = 0
+        self.bytes = 0
+        conn = sqlite3.connect(sqlite_dbfile)
+        try:
+            for name_id, short_name in conn.execute("SELECT name_id, short_name FROM win32service_history_names WHERE host = ?", (host,)):
+                self.ids[sys.intern(short_name)] = name_id
+        finally:
+            conn.close()
+        self.next_id = max(self.ids.values()) + 1 if self.ids else 1
+
+    def name_id(self, short_name, names):
+        name_id = self.ids.get(short_name)
+        if (name_id is None):
+            name_id = self.ids[sys.intern(short_name)] = self.next_id
+            self.next_id += 1
+            names.append((self.host, name_id, short_name))
+        return name_id
+
+    """ entries are (short_name, desc, status) tuples for added / changed
+        services, removed a list of short names, taken epoch seconds.
+        Entries already recorded in their current state are skipped """
+    def record(self, entries, removed, taken=None):
+        if (taken is None):
+            taken = int(time.time())
+        names = []
+        delta = {}
+        current = self.current
+        for entry in entries:
+            name_id = self.name_id(entry[0], names)
+            if (current.get(name_id) != (entry[2][1] + 1)):
+                delta[name_id] = entry[2][1] + 1
+        for short_name in removed:
+            delta[self.name_id(short_name, names)] = 0
+        for name_id, value in delta.items():
+            if value:
+                current[name_id] = value
+            else:
+                current.pop(name_id, None)
+        if ((self.last_keyframe is None) or ((taken - self.last_keyframe) >= self.keyframe_interval)):
+            self.last_keyframe = taken
+            row = (self.host, taken, 1, encode_state_delta(sorted(current.items())))
+        elif delta:
+            row = (self.host, taken, 0, encode_state_delta(sorted(delta.items())))
+        else:
+            return
+        self.rows += 1
+        self.bytes += len(row[3])
+        add_history_to_db([row], names, self.sqlite_dbfile)
+
+""" Time-travel queries over win32service_history for one host.
+    Timestamps are epoch seconds; states come back as serviceStates names """
+class snapshot_history_reader:
+    def __init__(self, sqlite_dbfile, host=''):
+        self.host = host
+        self.conn = sqlite3.connect(sqlite_dbfile)
+        self.names = {}
+
+    def name_of(self, name_id):
+        if (name_id not in self.names):
+            for row_id, short_name in self.conn.execute("SELECT name_id, short_name FROM win32service_history_names WHERE host = ?", (self.host,)):
+                self.names[row_id] = short_name
+        return self.names.get(name_id, name_id)
+
+    def state_ids_at(self, when):
+        row = self.conn.execute("SELECT max(taken) FROM win32service_history WHERE host = ? AND keyframe = 1 AND taken <= ?", (self.host, when)).fetchone()
+        state = {}
+        if (row[0] is None):
+            return state
+        for (delta,) in self.conn.execute("SELECT delta FROM win32service_history WHERE host = ? AND taken >= ? AND taken <= ? ORDER BY taken, win32service_history_key", (self.host, row[0], when)):
+            for name_id, value in decode_state_delta(delta):
+                if value:
+                    state[name_id] = value
+                else:
+                    state.pop(name_id, None)
+        return state
+
+    """ {short_name: state} of every service present at when """
+    def state_at(self, when):
+        return dict((self.name_of(name_id), serviceStates.get(value - 1, value - 1)) for name_id, value in self.state_ids_at(when).items())
+
+    """ [(taken, short_name, old state, new state)] for start < taken <= end,
+        None standing for a service that wasn't there """
+    def changes(self, start, end):
+        state = self.state_ids_at(start)
+        changes = []
+        for (taken, keyframe, delta) in self.conn.execute("SELECT taken, keyframe, delta FROM win32service_history WHERE host = ? AND taken > ? AND taken <= ? ORDER BY taken, win32service_history_key", (self.host, start, end)):
+            items = decode_state_delta(delta)
+            if keyframe:
+                # a keyframe lists everything present, anything else is gone
+                present = set(name_id for name_id, value in items)
+                items = items + [(name_id, 0) for name_id in state if name_id not in present]
+            for name_id, value in items:
+                old = state.get(name_id, 0)
+                if (old == value):
+                    continue
+                if value:
+                    state[name_id] = value
+                else:
+                    del state[name_id]
+                changes.append((taken, self.name_of(name_id),
+                                serviceStates.get(old - 1, old - 1) if old else None,
+                                serviceStates.get(value - 1, value - 1) if value else None))
+        return changes
+
+    def close(self):
+        self.conn.close()
+
+""" Applies edits of expectedstate / forceexpectedstate /
+    ignore_this_service made in the db (query set, a db editor) to a
+    running statetable.
+
+    check() first compares PRAGMA data_version, which only moves when
+    another connection commits, so a cycle without db writes costs one
+    pragma.  Otherwise rows with a policy_seq past the highest one seen so
+    far are read through win32service_policy_seq_idx and only the entries
+    that differ
+    are patched; those services are invalidated in the detector so the
+    same poll re-evaluates them """
+class policy_reloader:
+    policy_columns = ('expectedstate', 'forceexpectedstate', 'ignore_this_service')
+
+    def __init__(self, sqlite_dbfile, host=''):
+        self.sqlite_dbfile = sqlite_dbfile
+        self.host = host
+        self.conn = None
+        self.data_version = None
+        self.last_seq = 0
+        self.checks = 0
+        self.queries = 0
+        self.patched = 0
+
+    """ Takes the baseline; call before loading the statetable so no edit
+        falls in between """
+    def connect(self):
+        self.conn = sqlite3.connect(self.sqlite_dbfile, check_same_thread=False)
+        row = self.conn.execute("SELECT max(policy_seq) FROM win32service").fetchone()
+        self.last_seq = row[0] or 0
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    """ Returns the short names whose policy changed """
+    def check(self, statetable, detector, logfile, sqlite_dbfile):
+        self.checks += 1
+        try:
+            if (self.conn is None):
+                self.connect()
+                return []
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if (data_version == self.data_version):
+                return []
+            self.data_version = data_version
+            self.queries += 1
+            rows = self.conn.execute("SELECT short_name, expectedstate, forceexpectedstate, ignore_this_service, policy_seq "
+                                     "FROM win32service INDEXED BY win32service_policy_seq_idx "
+                                     "WHERE policy_seq > ? AND host = ? ORDER BY policy_seq",
+                                     (self.last_seq, self.host)).fetchall()
+        except sqlite3.Error:
+            log_error_msg("Failed to check for policy edits: " + self.sqlite_dbfile)
+            return []
+        changed = []
+        for (short_name, expectedstate, forceexpectedstate, ignore_this_service, policy_seq) in rows:
+            self.last_seq = policy_seq
+            if (short_name not in statetable):
+                continue
+            svc = statetable[short_name]
+            policy = (expectedstate, forceexpectedstate, ignore_this_service)
+            if (policy == tuple(svc[column] for column in self.policy_columns)):
+                continue
+            for column, value in zip(self.policy_columns, policy):
+                svc[column] = value and sys.intern(value)
+            detector.invalidate(short_name)
+            changed.append(short_name)
+            write_to_log(("Policy reloaded for " + short_name + ": expectedstate " + str(expectedstate) + ", forceexpectedstate " + str(forceexpectedstate) + ", ignore_this_service " + str(ignore_this_service)), short_name, logfile, sqlite_dbfile, 'policy')
+        self.patched += len(changed)
+        return changed
+
+    def close(self):
+        if (self.conn is not None):
+            self.conn.close()
+            self.conn = None
+
+""" new_svc dict for a service found by enum_services(), without the
+    registry values (ImagePath, ObjectName) """
+def new_service_dict(short_name, desc, status):
+    serviceState = serviceStates.get(status[1], status[1])
+    if status[0] in serviceTypes:
+        serviceType = serviceTypes[status[0]]
+    else:
+        serviceType = status[1]
+    # define the new service
+    new_svc = {}
+    new_svc['service_short_name'] = short_name
+    new_svc['service_description'] = desc
+    new_svc['expectedstate'] = serviceState # We default to taking new services @ expected state
+    new_svc['laststate'] = serviceState
+    new_svc['servicetype'] = serviceType
+    new_svc['forceexpectedstate'] = None
+    new_svc['ignore_this_service'] = 'yes'
+    return new_svc
+
+""" First run on an empty db: every enumerated service is new.  Instead of
+    the per-service path (registry lookup, insert and four log lines each)
+    the registry is read for all of them on a pool of max_workers threads,
+    the rows go to win32service in one executemany transaction and a single
+    summary record is logged.  Returns the number of services imported """
+def discover_services(statetable, entries, logfile, sqlite_dbfile, backend, max_workers=bulk_discovery_workers):
+    started = time.perf_counter()
+    new_svcs = [new_service_dict(short_name, desc, status) for (short_name, desc, status) in entries]
+    names = [new_svc['service_short_name'] for new_svc in new_svcs]
+    if ((max_workers > 1) and (len(names) > 1)):
+        with concurrent.futures.ThreadPoolExecutor(min(max_workers, len(names))) as executor:
+            configs = list(executor.map(backend.query_service_config, names))
+    else:
+        configs = [backend.query_service_config(short_name) for short_name in names]
+    looked_up = time.perf_counter()
+    states = {}
+    for new_svc, config in zip(new_svcs, configs):
+        new_svc.update(config)
+        # Expand out any env variables used in the impagepath values
+        new_svc['ImagePath'] = expand_env_vars(new_svc['ImagePath'])
+        statetable[new_svc['service_short_name']] = service_record.from_dict(new_svc)
+        states[new_svc['laststate']] = states.get(new_svc['laststate'], 0) + 1
+    add_new_services_to_db(new_svcs, sqlite_dbfile, logfile)
+    elapsed = time.perf_counter() - started
+    if (metrics is not None):
+        metrics.count('services_discovered', len(new_svcs))
+        metrics.observe('bulk_discovery', elapsed)
+    counts = ', '.join(str(count) + ' ' + str(state) for state, count in sorted(states.items(), key=lambda item: str(item[0])))
+    write_to_log(('First run: ' + str(len(new_svcs)) + ' windows services discovered (' + counts + '), registry read in ' + ('%.2f' % (looked_up - started)) + 's, all set to ignore_this_service'), '', logfile, sqlite_dbfile, 'discovered')
+    return len(new_svcs)
 
-    
 """ routine to use win32service/api/etc to check current status of windows
     services against statetable{} 
     
     services with forceexpectedstate = 'yes' will cue force_state_if_necessary()
+
+    backend defaults to the live SCM via pywin32_scm_backend.  detector keeps
+    the previous poll between calls; without one every service is walked as
+    if it had just changed and removed services can't be detected.  enforcer
+    moves start/stop actions off the poll onto an enforcement_scheduler.
+    With include_ignored = False state changes of services on the ignore
+    list are left pending in the detector for a later full check.  history
+    (a snapshot_history) records each poll's changes.  With bulk_discovery
+    a first poll against an empty statetable goes through
+    discover_services()
     """
-def check_services(statetable, logfile, sqlite_dbfile):
-    accessSCM = win32con.GENERIC_READ
-    #Open Service Control Manager
-    hscm = win32service.OpenSCManager(None, None, accessSCM)
-    #Enumerate Service Control Manager DB
-    typeFilter = win32service.SERVICE_WIN32
-    stateFilter = win32service.SERVICE_STATE_ALL
-    statuses = win32service.EnumServicesStatus(hscm, typeFilter, stateFilter)
-    for (short_name, desc, status) in statuses:
+def check_services(statetable, logfile, sqlite_dbfile, backend=None, detector=None, enforcer=None, include_ignored=True, history=None):
+    if (backend is None):
+        backend = pywin32_scm_backend()
+    if (detector is None):
+        detector = service_change_detector()
+    if (metrics is not None):
+        started = time.perf_counter()
+    statuses = backend.enum_services()
+    if (metrics is not None):
+        enumerated = time.perf_counter()
+        metrics.observe('enumerate', enumerated - started)
+    defer = None
+    if not include_ignored:
+        defer = lambda short_name: (short_name in statetable) and (statetable[short_name]['ignore_this_service'] != None)
+    added, changed, removed = detector.diff(statuses, defer)
+    if (not detector.statetable_checked) and ((not isinstance(statetable, warming_state_table)) or statetable.warm.is_set()):
+        # services in the statetable that are gone since the last run
+        detector.statetable_checked = True
+        removed = removed + [short_name for short_name, svc in statetable.items()
+                             if (svc['inactivated'] is None) and (short_name not in detector.snapshot)]
+    if (metrics is not None):
+        metrics.observe('diff', time.perf_counter() - enumerated)
+        metrics.count('services_changed', len(added) + len(changed) + len(removed))
+    if (history is not None):
+        history.record(added + changed + detector.deferred, removed)
+    if (bulk_discovery and added and not changed and not removed):
+        if (statetable.is_empty() if isinstance(statetable, warming_state_table) else (len(statetable) == 0)):
+            discover_services(statetable, added, logfile, sqlite_dbfile, backend, bulk_discovery_workers)
+            added = []
+    now = time.monotonic()
+    laststate_updates = []
+    summary_updates = []
+    transitions = []            # services that went (further) out of state
+    returned = []               # services back in their expectedstate
+    previous_states = {}        # laststate before this poll, for the log file
+    for (short_name, desc, status) in (added + changed):
+        if status[1] in serviceStates:
+            serviceState = serviceStates[status[1]]
+        else:
+            serviceState = status[1]
         if short_name in statetable:
-            # if the service is recorded in the statetable, check to see
-            # whether ServiceState (running/stopped/etc) matches expectedstate or not
-            if status[1] in serviceStates:
-                serviceState = serviceStates[status[1]]
-            else:
-                serviceState = status[1]
-            if (statetable[short_name]['ignore_this_service'] != None):
-                # do nothing if it's on the ignore list
-                pass
-            elif (serviceState != statetable[short_name]['expectedstate']):
-                logentry = 'Windows service: ' + short_name + '(' + statetable[short_name]['service_description'] + ') is ' + serviceState + ' - not in expectedstate (' + statetable[short_name]['expectedstate'] + ')'
-                write_to_log(logentry, short_name, logfile, sqlite_dbfile)
-                force_state_if_necessary(statetable, short_name, serviceState, logfile, sqlite_dbfile)
+            # if the service is recorded in the statetable, record its state
+            # and check whether it matches expectedstate or not
+            svc = statetable[short_name]
+            if (svc['laststate'] != serviceState) or (svc['inactivated'] is not None):
+                # a reinstalled service is active again
+                previous_states[short_name] = svc['laststate']
+                svc['laststate'] = serviceState
+                svc['inactivated'] = None
+                laststate_updates.append((serviceState, None, None, short_name))
+            record = detector.out_of_state.get(short_name)
+            if (svc['ignore_this_service'] == None) and (serviceState != svc['expectedstate']):
+                if (record is None):
+                    detector.out_of_state[short_name] = out_of_state_record(now, serviceState, svc['expectedstate'])
+                    summary_updates.append((short_name, 1, 0.0, 0, db_timestamp(), None))
+                    transitions.append(short_name)
+                elif (record.state != serviceState) or (record.expectedstate != svc['expectedstate']):
+                    record.state = serviceState
+                    record.expectedstate = svc['expectedstate']
+                    transitions.append(short_name)
+            elif (record is not None):
+                # back in expectedstate, or now on the ignore list
+                del detector.out_of_state[short_name]
+                summary_updates.append(record.summary_row(short_name, now, last_back_in_state=db_timestamp()))
+                if (svc['ignore_this_service'] == None):
+                    returned.append((short_name, serviceState, now - record.since))
         else:
             # if not in the statetable, must be a new service, create in
             # statetable, log to file/db
-            if status[1] in serviceStates:
-                serviceState = serviceStates[status[1]]
-            else:
-                serviceState = status[1]
+            new_svc = new_service_dict(short_name, desc, status)
             
-            if status[0] in serviceTypes:
-                serviceType = serviceTypes[status[0]]
-            else:
-                serviceType = status[1]
-            # define the new service
-            new_svc = {}
-            new_svc['service_short_name'] = short_name
-            new_svc['service_description'] = desc
-            new_svc['expectedstate'] = serviceState # We default to taking new services @ expected state
-            new_svc['laststate'] = serviceState
-            new_svc['servicetype'] = serviceType
-            new_svc['ignore_this_service'] = 'yes'
-            
-            # Some facets of services only seem to be available via the registry
-            # we try and get the executable + run-with-credentials here
-            access = win32con.KEY_READ | win32con.KEY_ENUMERATE_SUB_KEYS | win32con.KEY_QUERY_VALUE
-            hkey_base = "SYSTEM\\CurrentControlSet\\Services"
-            hkey_key = "\\" + short_name
-            try:
-                hkey = win32api.RegOpenKey(win32con.HKEY_LOCAL_MACHINE, (hkey_base + hkey_key), 0, access)
-                regkey = str(win32api.RegQueryValueEx(hkey, "ImagePath")[0])
-                new_svc['ImagePath'] = regkey
-            except:
-                new_svc['ImagePath'] = ''
-            try:
-                hkey = win32api.RegOpenKey(win32con.HKEY_LOCAL_MACHINE, (hkey_base + hkey_key), 0, access)
-                regkey = str(win32api.RegQueryValueEx(hkey, "ObjectName")[0])
-                new_svc['ObjectName'] = regkey
-            except:
-                new_svc['ObjectName'] = ''
+            # executable + run-with-credentials come from the backend
+            if (metrics is not None):
+                started = time.perf_counter()
+            new_svc.update(backend.query_service_config(short_name))
+            if (metrics is not None):
+                metrics.observe('registry_lookup', time.perf_counter() - started)
             
             # Expand out any env variables used in the impagepath values
-            check_for_os_environ = new_svc['ImagePath'].split('%')[0]
-            if (check_for_os_environ is ''):
-                try:
-                   envvar = os.environ[new_svc['ImagePath'].split('%')[1]]
-                   rest_of_path = new_svc['ImagePath'].split('%')[2]
-                   new_svc['ImagePath'] = (envvar + rest_of_path)
-                except:
-                    pass
+            new_svc['ImagePath'] = expand_env_vars(new_svc['ImagePath'])
                 
-            statetable[short_name] = new_svc
+            statetable[short_name] = service_record.from_dict(new_svc)
             
             # Send new service to db
             add_new_service_to_db(new_svc, sqlite_dbfile, logfile)
             
-            # Send output to the log file
-            curtime = datetime.datetime.isoformat(datetime.datetime.now())
-            log_message = curtime + ' : New windows service discovered : ' + short_name
-            write_to_log(log_message, short_name, logfile, sqlite_dbfile)
-            log_message = curtime + ' :    - ' + desc
-            write_to_log(log_message, short_name, logfile, sqlite_dbfile)
+            # Send output to the log file, dated by the record's timestamp
+            log_message = 'New windows service discovered : ' + short_name
+            write_to_log(log_message, short_name, logfile, sqlite_dbfile, 'discovered', None, serviceState)
+            log_message = '   - ' + desc
+            write_to_log(log_message, short_name, logfile, sqlite_dbfile, 'discovered')
             if ('ImagePath' in new_svc):
-                log_message = curtime + ' :    - path: ' + new_svc['ImagePath']
-                write_to_log(log_message, short_name, logfile, sqlite_dbfile)
+                log_message = '   - path: ' + new_svc['ImagePath']
+                write_to_log(log_message, short_name, logfile, sqlite_dbfile, 'discovered')
             if ('ObjectName' in new_svc):
-                log_message = curtime + ' :    - running as user: ' + new_svc['ObjectName']
-                write_to_log(log_message, short_name, logfile, sqlite_dbfile)
+                log_message = '   - running as user: ' + new_svc['ObjectName']
+                write_to_log(log_message, short_name, logfile, sqlite_dbfile, 'discovered')
+
+    for short_name in removed:
+        # services that disappeared are marked inactivated, not deleted
+        record = detector.out_of_state.pop(short_name, None)
+        if (record is not None):
+            summary_updates.append(record.summary_row(short_name, now))
+        if hasattr(backend, 'forget'):
+            backend.forget(short_name)
+        if short_name in statetable:
+            statetable[short_name]['inactivated'] = db_timestamp()
+            laststate_updates.append((statetable[short_name]['laststate'], statetable[short_name]['inactivated'], "windows_service_monitor", short_name))
+        write_to_log(('Windows service removed: ' + short_name), short_name, logfile, sqlite_dbfile, 'removed', statetable[short_name]['laststate'] if (short_name in statetable) else None, None)
+
+    if laststate_updates:
+        update_services_in_db(laststate_updates, sqlite_dbfile, logfile)
+
+    if not log_state_transitions_only:
+        # original behaviour, every out-of-state service every poll
+        transitions = sorted(detector.out_of_state)
+    for short_name in transitions:
+        serviceState = detector.state_of(short_name)
+        logentry = 'Windows service: ' + short_name + '(' + statetable[short_name]['service_description'] + ') is ' + serviceState + ' - not in expectedstate (' + statetable[short_name]['expectedstate'] + ')'
+        write_to_log(logentry, short_name, logfile, sqlite_dbfile, 'out_of_state', previous_states.get(short_name), serviceState)
+        force_state_if_necessary(statetable, short_name, serviceState, logfile, sqlite_dbfile, backend, enforcer)
+    for (short_name, serviceState, seconds) in returned:
+        logentry = 'Windows service: ' + short_name + '(' + statetable[short_name]['service_description'] + ') is ' + serviceState + ' - back in expectedstate after ' + minutes_text(seconds)
+        write_to_log(logentry, short_name, logfile, sqlite_dbfile, 'back_in_state', previous_states.get(short_name), serviceState)
+
+    # services that stay out of state are only counted, with a rolled-up
+    # record (and another enforcement attempt) every rollup interval
+    for short_name, record in detector.out_of_state.items():
+        record.polls += 1
+        if ((now - record.last_report) >= out_of_state_rollup_interval):
+            record.last_report = now
+            summary_updates.append(record.summary_row(short_name, now))
+            if log_state_transitions_only:
+                logentry = 'Windows service: ' + short_name + '(' + statetable[short_name]['service_description'] + ') is ' + record.state + ' - still not in expectedstate (' + record.expectedstate + ') for ' + minutes_text(now - record.since)
+                write_to_log(logentry, short_name, logfile, sqlite_dbfile, 'still_out_of_state', None, record.state)
+                force_state_if_necessary(statetable, short_name, record.state, logfile, sqlite_dbfile, backend, enforcer)
+
+    if summary_updates:
+        update_state_summary_in_db(summary_updates, sqlite_dbfile, logfile)
     return statetable
 
-""" fix this! """
+""" When the next poll is due, for run_monitor's poll mode.
+
+    With adaptive_polling the interval drops to min_interval after a poll
+    that saw changes and grows by poll_backoff per quiet poll up to
+    max_interval; otherwise it stays at check_services_interval.  Polls are
+    scheduled from the start of the previous one so they don't drift.
+    Monitored services are checked every poll, ignored ones only on a full
+    check every ignored_interval seconds """
+class poll_schedule:
+    def __init__(self, interval=check_services_interval, min_interval=check_services_min_interval,
+                 max_interval=check_services_max_interval, backoff=poll_backoff,
+                 ignored_interval=ignored_services_interval, adaptive=adaptive_polling):
+        self.base_interval = interval
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.backoff = backoff
+        self.ignored_interval = ignored_interval
+        self.adaptive = adaptive
+        now = time.monotonic()
+        self.next_poll = now
+        self.next_full = now
+
+    """ True when the poll starting at now should include ignored services """
+    def full_due(self, now):
+        return (now >= self.next_full)
+
+    def completed(self, started, changes, full):
+        if not self.adaptive:
+            self.interval = self.base_interval
+        elif changes:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        now = time.monotonic()
+        self.next_poll = max(started + self.interval, now)
+        if full:
+            self.next_full = max(started + self.ignored_interval, now)
+
+    """ Seconds until the next poll (or full check) is due """
+    def remaining(self):
+        return max(0.0, min(self.next_poll, self.next_full) - time.monotonic())
+
+""" Main monitor loop, shared by SvcDoRun and the benchmarks.
+
+    stop_requested(timeout) blocks for up to timeout seconds and returns True
+    once the monitor should stop.  Without a notification source services
+    are polled on a poll_schedule, waiting on stop_requested() for exactly
+    the time to the next poll.  With one, a check runs
+    as soon as events arrive (bursts are handled in one pass) and a full
+    reconciliation runs every reconcile_interval seconds as a safety net
+    against missed notifications.  The (event, short_name) payloads are not
+    used: an event only triggers a check of every service, which costs one
+    EnumServicesStatus call and also picks up changes whose notification
+    was lost """
+def run_monitor(statetable, logfile, sqlite_dbfile, backend, detector, stop_requested, notifications=None, enforcer=None, schedule=None, history=None, policy=None):
+    if (notifications is None):
+        if (schedule is None):
+            schedule = poll_schedule()
+        while True:
+            started = time.monotonic()
+            full = schedule.full_due(started)
+            """ Put in all fucntional code here! """
+            monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, enforcer, full, history, policy)
+            schedule.completed(started, detector.last_changes, full)
+            if stop_requested(schedule.remaining()):
+                return
+    last_reconcile = time.monotonic()
+    monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, enforcer, history=history, policy=policy)
+    while True:
+        remaining = reconcile_interval - (time.monotonic() - last_reconcile)
+        events = notifications.wait(remaining)
+        if stop_requested(0):
+            return
+        if (events or (remaining <= 0)):
+            if not events:
+                last_reconcile = time.monotonic()
+            monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, enforcer, history=history, policy=policy)
+
+""" Looks up ImagePath / ObjectName of every known, currently installed
+    service through the backend's service_metadata_cache, which only reads
+    a key's values again when it has been written since the last lookup.
+    Services whose executable or account changed are updated in the
+    statetable and db and logged.  Returns their short names """
+def refresh_service_metadata(statetable, logfile, sqlite_dbfile, backend, detector):
+    changed = []
+    rows = []
+    for short_name in list(detector.snapshot):
+        if (short_name not in statetable):
+            continue
+        svc = statetable[short_name]
+        config = backend.query_service_config(short_name)
+        image_path = expand_env_vars(config['ImagePath'])
+        # rows written before paths were expanded on insert still hold %vars%
+        old_path = expand_env_vars(str(svc['ImagePath'])).replace('"', '')
+        old_account = str(svc['ObjectName'])
+        if ((image_path.replace('"', '') == old_path) and (config['ObjectName'] == old_account)):
+            continue
+        svc['ImagePath'] = image_path
+        svc['ObjectName'] = config['ObjectName']
+        rows.append((image_path.replace('"', ''), config['ObjectName'], short_name))
+        changed.append(short_name)
+        logentry = 'Windows service: ' + short_name + ' reconfigured, path: ' + old_path + ' -> ' + image_path.replace('"', '') + ', running as user: ' + old_account + ' -> ' + config['ObjectName']
+        write_to_log(logentry, short_name, logfile, sqlite_dbfile, 'reconfigured')
+    if rows:
+        update_service_config_in_db(rows, sqlite_dbfile, logfile)
+    return changed
+
+""" One pass of the monitor: report finished enforcement actions, apply
+    policy edits (policy_reloader), check services, refresh known services'
+    registry metadata when due, then flush the log writer """
+def monitor_cycle(statetable, logfile, sqlite_dbfile, backend, detector, enforcer=None, include_ignored=True, history=None, policy=None):
+    if (metrics is not None):
+        started = time.perf_counter()
+    if (enforcer is not None):
+        report_enforcement_results(enforcer, logfile, sqlite_dbfile)
+    if (policy is not None):
+        policy.check(statetable, detector, logfile, sqlite_dbfile)
+    check_services(statetable, logfile, sqlite_dbfile, backend, detector, enforcer, include_ignored, history)
+    # iterating a warming_state_table has to wait until it is loaded
+    warming = isinstance(statetable, warming_state_table) and not statetable.warm.is_set()
+    if (hasattr(backend, 'refresh_due') and not warming and backend.refresh_due()):
+        refresh_service_metadata(statetable, logfile, sqlite_dbfile, backend, detector)
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.flush()
+    if (metrics is not None):
+        metrics.observe('poll_cycle', time.perf_counter() - started)
+
+""" Polling state fleet_collector keeps for one host """
+class fleet_host:
+    __slots__ = ('host', 'backend', 'writer', 'statetable', 'detector', 'policy', 'next_due',
+                 'started', 'timed_out', 'polls', 'failures', 'timeouts', 'poll_seconds')
+
+    def __init__(self, host, backend, writer, sqlite_dbfile):
+        self.host = host
+        self.backend = backend
+        self.writer = writer
+        self.statetable = None
+        self.detector = service_change_detector()
+        self.policy = policy_reloader(sqlite_dbfile, host)
+        self.next_due = 0.0
+        self.started = None
+        self.timed_out = False
+        self.polls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.poll_seconds = 0.0
+
+""" Polls a list of remote hosts into the same db, tagging every row with
+    the host name.
+
+    Each host gets its own backend (backend_factory(host), by default a
+    cached pywin32_scm_backend for that machine), statetable and change
+    detector, and is checked with the same check_services() as the local
+    machine, on a pool of max_workers threads.  Hosts are polled every
+    interval seconds on schedules spread out by jitter so they don't all
+    hit the writer at once.  A host is never polled twice at the same time;
+    a poll still running after host_timeout seconds is reported once and
+    the host is skipped until it returns (SCM calls can't be cancelled).
+    writer must be thread safe, i.e. a background_log_writer """
+class fleet_collector:
+    def __init__(self, hosts, sqlite_dbfile, logfile, writer, backend_factory=None, max_workers=fleet_workers,
+                 host_timeout=fleet_host_timeout, interval=check_services_interval, jitter=fleet_jitter):
+        if (backend_factory is None):
+            backend_factory = lambda host: service_metadata_cache(pywin32_scm_backend(host))
+        self.sqlite_dbfile = sqlite_dbfile
+        self.logfile = logfile
+        self.writer = writer
+        self.host_timeout = host_timeout
+        self.interval = interval
+        self.jitter = jitter
+        self.hosts = [fleet_host(host, backend_factory(host), host_log_writer(writer, host), sqlite_dbfile) for host in hosts]
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.in_flight = {}     # host -> future
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="fleet_collector")
+        self.thread.daemon = True
+
+    def poll_host(self, host):
+        host.started = time.monotonic()
+        host.timed_out = False
+        writer_context.writer = host.writer
+        try:
+            if (host.statetable is None):
+                host.policy.connect()
+                host.statetable = read_state_table_from_db_file({}, self.logfile, self.sqlite_dbfile, host.host)
+                if (host.statetable is None):
+                    raise RuntimeError('cannot load statetable')
+            host.policy.check(host.statetable, host.detector, self.logfile, self.sqlite_dbfile)
+            check_services(host.statetable, self.logfile, self.sqlite_dbfile, host.backend, host.detector)
+        except Exception as e:
+            host.failures += 1
+            write_to_log(("Failed to poll host " + host.host + ": " + str(e)), "", self.logfile, self.sqlite_dbfile)
+        finally:
+            writer_context.writer = None
+            elapsed = time.monotonic() - host.started
+            host.polls += 1
+            host.poll_seconds += elapsed
+            host.started = None
+            if (metrics is not None):
+                metrics.observe('host_poll', elapsed)
+
+    """ Queues a poll of host unless one is still running, returns its future """
+    def submit(self, host):
+        if (host.host in self.in_flight):
+            return None
+        future = self.executor.submit(self.poll_host, host)
+        self.in_flight[host.host] = future
+        future.add_done_callback(lambda f, name=host.host: self.in_flight.pop(name, None))
+        return future
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        for host in self.hosts:
+            started = host.started
+            if ((started is not None) and not host.timed_out and ((now - started) > self.host_timeout)):
+                host.timed_out = True
+                host.timeouts += 1
+                host.writer.log(("Timed out polling host " + host.host + " after " + str(int(now - started)) + "s"), "")
+
+    """ Polls every host once, waiting up to host_timeout for the slowest.
+        Returns (hosts finished, hosts still running) """
+    def run_cycle(self):
+        futures = [future for future in (self.submit(host) for host in self.hosts) if (future is not None)]
+        done, not_done = concurrent.futures.wait(futures, timeout=self.host_timeout)
+        self.check_timeouts()
+        self.writer.flush()
+        return len(done), len(not_done)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        now = time.monotonic()
+        for host in self.hosts:
+            # spread the first polls over one interval
+            host.next_due = now + random.uniform(0, self.interval)
+        while self.hosts:
+            now = time.monotonic()
+            for host in self.hosts:
+                if (host.next_due <= now):
+                    self.submit(host)
+                    host.next_due = max(host.next_due + self.interval, now) + random.uniform(-self.jitter, self.jitter) * self.interval
+            self.check_timeouts()
+            wait = min(host.next_due for host in self.hosts) - time.monotonic()
+            if self.stopping.wait(max(wait, 0.01)):
+                return
+
+    """ Totals over all hosts """
+    def stats(self):
+        polls = sum(host.polls for host in self.hosts)
+        return {'hosts': len(self.hosts),
+                'polls': polls,
+                'failures': sum(host.failures for host in self.hosts),
+                'timeouts': sum(host.timeouts for host in self.hosts),
+                'mean_poll_seconds': (sum(host.poll_seconds for host in self.hosts) / polls) if polls else 0.0}
+
+    def stop(self, timeout=30):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        # polls stuck in an SCM call are left to finish on their own
+        self.executor.shutdown(wait=False)
+        for host in self.hosts:
+            if (host.started is None):
+                host.policy.close()
+
+""" Sends a batch of (laststate, inactivated, inactivated_by, short_name)
+    rows to the win32service table in a single UPDATE """
+def update_services_in_db(rows, sqlite_dbfile, logfile):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.update_services(rows)
+        return
+    try:
+        conn = sqlite3.connect(sqlite_dbfile)
+        c = conn.cursor()
+        c.executemany(update_service_sql, [row + ('',) for row in rows])
+        conn.commit()
+        conn.close()
+    except:
+        log_error_msg("Error, cannot update laststate in db: " + sqlite_dbfile)
+
+""" Sends a batch of (ImagePath, ObjectName, short_name) rows to the
+    win32service table """
+def update_service_config_in_db(rows, sqlite_dbfile, logfile):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.update_service_config(rows)
+        return
+    try:
+        conn = sqlite3.connect(sqlite_dbfile)
+        c = conn.cursor()
+        c.executemany(update_config_sql, [row + ('',) for row in rows])
+        conn.commit()
+        conn.close()
+    except:
+        log_error_msg("Error, cannot update service config in db: " + sqlite_dbfile)
+
+""" Applies a batch of win32service_state_summary delta rows """
+def update_state_summary_in_db(rows, sqlite_dbfile, logfile):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.update_state_summary(rows)
+        return
+    try:
+        conn = sqlite3.connect(sqlite_dbfile)
+        c = conn.cursor()
+        c.executemany(insert_summary_sql, [(row[0], '') for row in rows])
+        c.executemany(update_summary_sql, [row[1:] + (row[0], '') for row in rows])
+        conn.commit()
+        conn.close()
+    except:
+        log_error_msg("Error, cannot update state summary in db: " + sqlite_dbfile)
+
+""" Writes win32service_history rows and any new history name ids """
+def add_history_to_db(rows, names, sqlite_dbfile):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.add_history(rows, names)
+        return
+    try:
+        conn = sqlite3.connect(sqlite_dbfile)
+        c = conn.cursor()
+        c.executemany(insert_history_name_sql, names)
+        c.executemany(insert_history_sql, rows)
+        conn.commit()
+        conn.close()
+    except:
+        log_error_msg("Error, cannot add service history to db: " + sqlite_dbfile)
+
+""" Inserts a newly discovered service into the win32service table """
 def add_new_service_to_db(new_svc, sqlite_dbfile, logfile):
-    
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.add_service(new_svc)
+        return
     try:
         conn = sqlite3.connect(sqlite_dbfile)
         c = conn.cursor()
-        sql = "INSERT INTO win32service (short_name, description, laststate, "
-        sql += "expectedstate, servicetype, ImagePath, ObjectName, established, "
-        sql += "established_by, ignore_this_service) VALUES ("
-        sql += "'" + new_svc['service_short_name'].replace("'", "''") + "', "
-        sql += "'" + new_svc['service_description'].replace("'", "''") + "', "
-        sql += "'" + new_svc['laststate'].replace("'", "''") + "', "
-        sql += "'" + new_svc['expectedstate'].replace("'", "''") + "', "
-        sql += "'" + str(new_svc['servicetype']).replace("'", "''") + "', "
-        sql += "'" + str(new_svc['ImagePath']).replace("'", "''").replace('"', '') + "', "
-        sql += "'" + str(new_svc['ObjectName']).replace("'", "''") + "', "
-        sql += "" + "datetime('now','localtime')" + ", "
-        sql += "'" + "windows_service_monitor" + "', "
-        sql += "'" + new_svc['ignore_this_service'].replace("'", "''") + "')"
-        c.execute(sql)
+        c.execute(insert_service_sql, new_service_row(new_svc))
         conn.commit()
         conn.close()
     except:
-        write_to_log("Error adding new Service to db", short_name, logfile, sqlite_dbfile)
+        write_to_log("Error adding new Service to db", new_svc['service_short_name'], logfile, sqlite_dbfile)
+
+""" Inserts a batch of newly discovered services in one transaction """
+def add_new_services_to_db(new_svcs, sqlite_dbfile, logfile):
+    writer = active_log_writer()
+    if (writer is not None):
+        writer.add_services(new_svcs)
+        return
+    try:
+        conn = sqlite3.connect(sqlite_dbfile)
+        with conn:
+            conn.executemany(insert_service_sql, [new_service_row(new_svc) for new_svc in new_svcs])
+        conn.close()
+    except:
+        write_to_log(("Error adding " + str(len(new_svcs)) + " new Services to db"), '', logfile, sqlite_dbfile)
 
-class windows_service_monitor(win32serviceutil.ServiceFramework):
+""" Query / report command line
+
+    windows_service_monitor_svc.py query [--db FILE] <command> ...
+
+    Reports run on a read-only connection, so they never take the write
+    lock from the running service (the db is in WAL mode), use indexed
+    queries and stream rows to stdout as tab separated lines.  'set' is
+    the only command that writes (and upgrades an older schema); reports
+    on an older schema fail instead.  --db defaults to the sqlite_dbfile
+    registry value when pywin32 is available """
+
+""" Read-only connection to sqlite_dbfile """
+def open_readonly_db(sqlite_dbfile):
+    uri = 'file:' + urllib.request.pathname2url(os.path.abspath(sqlite_dbfile)) + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=30)
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+""" Writes rows from cursor as tab separated lines under a header """
+def stream_rows(cursor, out):
+    out.write('\t'.join(column[0] for column in cursor.description) + '\n')
+    count = 0
+    for row in cursor:
+        out.write('\t'.join('' if (value is None) else str(value) for value in row) + '\n')
+        count += 1
+    return count
+
+def query_services(conn, args, out):
+    sql = "SELECT host, short_name, laststate, expectedstate, forceexpectedstate, ignore_this_service, description "
+    sql += "FROM win32service_current WHERE host = ?"
+    params = [args.host]
+    if not args.all:
+        sql += " AND inactivated IS NULL"
+    if args.like:
+        sql += " AND short_name LIKE ?"
+        params.append(args.like)
+    return stream_rows(conn.execute(sql + " ORDER BY short_name", params), out)
+
+def query_out_of_state(conn, args, out):
+    sql = "SELECT w.host, w.short_name, w.laststate, w.expectedstate, w.forceexpectedstate, "
+    sql += "s.last_out_of_state, s.out_of_state_count, w.description "
+    sql += "FROM win32service_current w LEFT JOIN win32service_state_summary s "
+    sql += "ON s.host = w.host AND s.win32service_short_name = w.short_name "
+    sql += "WHERE w.host = ? AND w.ignore_this_service IS NULL AND w.inactivated IS NULL "
+    sql += "AND w.laststate IS NOT w.expectedstate ORDER BY w.short_name"
+    return stream_rows(conn.execute(sql, (args.host,)), out)
+
+def query_changes(conn, args, out):
+    since = (datetime.datetime.now() - datetime.timedelta(hours=args.hours)).strftime('%Y-%m-%d %H:%M:%S')
+    sql = "SELECT established, host, win32service_short_name, logentry FROM win32service_log "
+    if args.service:
+        # win32service_log_short_name_idx, then the time range
+        sql += "WHERE win32service_short_name = ? AND host = ? AND established >= ? "
+        params = [args.service, args.host, since]
+    else:
+        # walks win32service_log_established_idx backwards from now
+        sql += "WHERE established >= ? AND host = ? "
+        params = [since, args.host]
+    sql += "ORDER BY established DESC LIMIT ?"
+    params.append(args.limit)
+    return stream_rows(conn.execute(sql, params), out)
+
+def query_offenders(conn, args, out):
+    since = (datetime.datetime.now() - datetime.timedelta(days=args.days)).strftime('%Y-%m-%d %H:%M:%S')
+    # recent entries from the log plus pruned ones from the daily summary
+    sql = "SELECT host, win32service_short_name, sum(entries) AS entries FROM ("
+    sql += "SELECT host, win32service_short_name, count(*) AS entries FROM win32service_log "
+    sql += "WHERE established >= ? GROUP BY host, win32service_short_name "
+    sql += "UNION ALL SELECT host, win32service_short_name, entries FROM win32service_log_daily WHERE day >= date(?)"
+    sql += ") GROUP BY host, win32service_short_name ORDER BY entries DESC LIMIT ?"
+    return stream_rows(conn.execute(sql, (since, since, args.limit)), out)
+
+""" Bulk edit of the policy columns for the named services (or every
+    service matching --like) on one host """
+def query_set(sqlite_dbfile, args, out):
+    updates = []
+    if (args.expectedstate is not None):
+        state = args.expectedstate.upper()
+        if not state.startswith('SERVICE_'):
+            state = 'SERVICE_' + state
+        if (state not in serviceStates.values()):
+            raise ValueError('unknown state: ' + args.expectedstate)
+        updates.append(('expectedstate', state))
+    if (args.forceexpectedstate is not None):
+        updates.append(('forceexpectedstate', 'yes' if (args.forceexpectedstate == 'yes') else None))
+    if (args.ignore is not None):
+        updates.append(('ignore_this_service', 'yes' if (args.ignore == 'yes') else None))
+    if not updates:
+        raise ValueError('nothing to set')
+    if not (args.names or args.like):
+        raise ValueError('name some services or use --like')
+    sql = "UPDATE win32service SET " + ', '.join(column + ' = ?' for column, value in updates) + ", edited = ?, edited_by = ? "
+    params = tuple(value for column, value in updates) + (db_timestamp(), 'windows_service_monitor_svc.py query')
+    conn = sqlite3.connect(sqlite_dbfile, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if args.like:
+            updated = conn.execute(sql + "WHERE host = ? AND short_name LIKE ?", params + (args.host, args.like)).rowcount
+        else:
+            updated = 0
+            for short_name in args.names:
+                updated += conn.execute(sql + "WHERE host = ? AND short_name = ?", params + (args.host, short_name)).rowcount
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    out.write(str(updated) + ' rows updated\n')
+    return updated
+
+def query_command_line(argv, out=sys.stdout):
+    parser = argparse.ArgumentParser(prog='windows_service_monitor_svc.py query', description='Report on / edit the Windows Service Monitor db')
+    parser.add_argument('--db', help='sqlite_dbfile (default: registry setting)')
+    parser.add_argument('--host', default='', help="host to report on (default: this machine, '')")
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('services', help='list services')
+    command.add_argument('--all', action='store_true', help='include removed services')
+    command.add_argument('--like', help='SQL LIKE pattern on short_name')
+    commands.add_parser('out-of-state', help='monitored services not in their expectedstate')
+    command = commands.add_parser('changes', help='recent log entries, newest first')
+    command.add_argument('--hours', type=float, default=24)
+    command.add_argument('--service', help='only this short_name')
+    command.add_argument('--limit', type=int, default=1000)
+    command = commands.add_parser('offenders', help='services with the most log entries')
+    command.add_argument('--days', type=float, default=7)
+    command.add_argument('--limit', type=int, default=20)
+    command = commands.add_parser('set', help='bulk edit expectedstate / forceexpectedstate / ignore_this_service')
+    command.add_argument('names', nargs='*', help='service short names')
+    command.add_argument('--like', help='SQL LIKE pattern on short_name instead of names')
+    command.add_argument('--expectedstate', help='e.g. SERVICE_RUNNING, running, stopped')
+    command.add_argument('--forceexpectedstate', choices=('yes', 'none'))
+    command.add_argument('--ignore', choices=('yes', 'none'))
+    args = parser.parse_args(argv)
+    if (args.command is None):
+        parser.print_help()
+        return 2
+    sqlite_dbfile = args.db
+    if (sqlite_dbfile is None):
+        if (win32api is None):
+            parser.error('--db is required without pywin32')
+        # only the setting: init_local_vars() would migrate the db
+        sqlite_dbfile = read_registry_setting("sqlite_dbfile")
+        if (sqlite_dbfile is None):
+            parser.error('cannot read sqlite_dbfile from the registry, use --db')
+    if not os.path.exists(sqlite_dbfile):
+        parser.error('no such db file: ' + sqlite_dbfile)
+    try:
+        if (args.command == 'set'):
+            migrate_w32services_db(sqlite_dbfile)
+            query_set(sqlite_dbfile, args, out)
+            return 0
+        conn = open_readonly_db(sqlite_dbfile)
+        # reports never write, not even a schema upgrade
+        if (conn.execute("PRAGMA user_version").fetchone()[0] < schema_migrations[-1][0]):
+            conn.close()
+            sys.stderr.write('error: db schema is older than this version, start the service once or run "query set" to upgrade it\n')
+            return 1
+        try:
+            reports = {'services': query_services, 'out-of-state': query_out_of_state,
+                       'changes': query_changes, 'offenders': query_offenders}
+            reports[args.command](conn, args, out)
+        finally:
+            conn.close()
+    except BrokenPipeError:
+        # e.g. piped into head
+        pass
+    except (ValueError, sqlite3.Error) as e:
+        sys.stderr.write('error: ' + str(e) + '\n')
+        return 1
+    return 0
+
+if (win32serviceutil is not None):
+    service_framework = win32serviceutil.ServiceFramework
+else:
+    service_framework = object
+
+class windows_service_monitor(service_framework):
     _svc_name_ = "Windows Service Monitor"
     _svc_display_name_ = "Windows Service Monitor"
 
@@ -409,41 +3175,111 @@ class windows_service_monitor(win32serviceutil.ServiceFramework):
     def SvcStop(self):
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         win32event.SetEvent(self.hWaitStop)
+        notifications = getattr(self, 'notifications', None)
+        if (notifications is not None):
+            notifications.interrupt()
+
+    def stop_requested(self, timeout):
+        rc = win32event.WaitForSingleObject(self.hWaitStop, int(timeout * 1000))
+        return (rc == win32event.WAIT_OBJECT_0)
 
     def SvcDoRun(self):
-        rc = None
-        x = 0
+        global log_writer, metrics
         # Each time the service is started we check for registry config vars
         sqlite_dbfile, logfile, regvar_success = init_local_vars()
         if (regvar_success == 0):
-            servicemanager.LogErrorMsg("sqlite_dbfile or logfile registry key error.  Please verify these keys are set to valid file locations.")
+            log_error_msg("sqlite_dbfile or logfile registry key error.  Please verify these keys are set to valid file locations.")
             self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
             win32event.SetEvent(self.hWaitStop)
             return
+        if convert_auto_vacuum:
+            try:
+                seconds = convert_to_incremental_vacuum(sqlite_dbfile)
+                if (seconds is not None):
+                    write_to_log(("Converted db to incremental auto_vacuum in " + ('%.1f' % seconds) + "s"), "", logfile, sqlite_dbfile)
+            except sqlite3.Error:
+                log_error_msg("Cannot convert db to incremental auto_vacuum: " + sqlite_dbfile)
+        # One db connection is kept open for the life of the service
+        try:
+            self.log_writer = background_log_writer(sqlite_dbfile, logfile)
+            log_writer = self.log_writer
+        except:
+            log_error_msg("Cannot open db writer, falling back to per-line writes: " + sqlite_dbfile)
+            self.log_writer = None
+        exporter = None
+        if (metrics_interval > 0):
+            metrics = monitor_metrics()
+            exporter = metrics_exporter(metrics, sqlite_dbfile)
+            exporter.start()
         # Each time the service is started we init the statetable from the db
-        statetable = {}
         start_time = datetime.datetime.isoformat(datetime.datetime.now())
         write_to_log(("*** Starting Windows Service Monitor @ " + str(start_time)), "", logfile, sqlite_dbfile)
         
-        statetable = read_state_table_from_db_file(statetable, logfile, sqlite_dbfile)
+        policy = policy_reloader(sqlite_dbfile)
+        try:
+            policy.connect()
+        except sqlite3.Error:
+            log_error_msg("Cannot watch for policy edits: " + sqlite_dbfile)
+        if lazy_statetable_load:
+            statetable = warming_state_table(logfile, sqlite_dbfile)
+        else:
+            statetable = read_state_table_from_db_file({}, logfile, sqlite_dbfile)
+        maintenance = db_maintenance_thread(sqlite_dbfile, logfile)
+        maintenance.start()
+        fleet = None
+        if (fleet_hosts and (self.log_writer is not None)):
+            fleet = fleet_collector(fleet_hosts, sqlite_dbfile, logfile, self.log_writer)
+            fleet.start()
+        backend = service_metadata_cache(pywin32_scm_backend())
+        detector = service_change_detector()
+        self.notifications = None
+        if (monitor_mode == 'notify'):
+            try:
+                self.notifications = scm_notification_source(backend)
+            except:
+                log_error_msg("Cannot register for service change notifications, falling back to polling")
     
-        while rc != win32event.WAIT_OBJECT_0:
-            if ((x % check_services_interval) == 0):
-                """ Put in all fucntional code here! """
-                check_services(statetable, logfile, sqlite_dbfile)
-            if x == 60:
-                x = 0;
-            time.sleep(1)
-            x = x + 1
-            rc = win32event.WaitForSingleObject(self.hWaitStop, 0)
+        enforcer = enforcement_scheduler(backend)
+        history = None
+        if snapshot_history_enabled:
+            try:
+                history = snapshot_history(sqlite_dbfile)
+            except:
+                log_error_msg("Cannot open service history: " + sqlite_dbfile)
+        run_monitor(statetable, logfile, sqlite_dbfile, backend, detector, self.stop_requested, self.notifications, enforcer, history=history, policy=policy)
+        policy.close()
+        if (self.notifications is not None):
+            self.notifications.close()
+        if (fleet is not None):
+            fleet.stop()
+            fleet_stats = fleet.stats()
+            write_to_log(("Fleet: " + str(fleet_stats['hosts']) + " hosts, " + str(fleet_stats['polls']) + " polls, " + str(fleet_stats['failures']) + " failed, " + str(fleet_stats['timeouts']) + " timed out"), "", logfile, sqlite_dbfile)
+        enforcer.close()
+        enforcement_stats = enforcer.stats()
+        write_to_log(("Enforcement: " + str(enforcement_stats['submitted']) + " actions, " + str(enforcement_stats['failed']) + " failed, " + str(enforcement_stats['timeout']) + " timed out, mean latency " + ('%.1f' % enforcement_stats['mean_latency_seconds']) + "s"), "", logfile, sqlite_dbfile)
+        maintenance.stop()
         
         try:
             end_time = datetime.datetime.isoformat(datetime.datetime.now())
             write_to_log(("*** Ending Windows Service Monitor @ " + str(end_time)), "", logfile, sqlite_dbfile)
         except:
             pass
+        cache_stats = backend.stats()
+        write_to_log(("Registry cache: " + str(cache_stats['lookups']) + " lookups, hit rate " + ('%.2f' % cache_stats['hit_rate']) + ", " + ('%.1f' % (cache_stats['lookup_seconds'] * 1000)) + "ms total"), "", logfile, sqlite_dbfile)
+        if (self.log_writer is not None):
+            stats = self.log_writer.stats()
+            write_to_log(("Log writer: " + str(stats['written']) + " events written, " + str(stats['dropped']) + " dropped, max queue depth " + str(stats['max_queue_depth']) + ", " + str(stats['failed_flushes']) + " failed db flushes, " + str(stats['db_rows_dropped']) + " db rows dropped"), "", logfile, sqlite_dbfile)
+            sink = self.log_writer.writer.sink
+            write_to_log(("Log file: " + str(sink.written) + " lines written, " + str(sink.dropped) + " dropped, " + str(sink.rotations) + " rotations"), "", logfile, sqlite_dbfile)
+            self.log_writer.close()
+            log_writer = None
+        if (exporter is not None):
+            exporter.stop()
+            metrics = None
         
 if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'query'):
+        sys.exit(query_command_line(sys.argv[2:]))
     if len(sys.argv) == 1:
         servicemanager.Initialize()
         servicemanager.PrepareToHostSingle(windows_service_monitor)